@@ -0,0 +1,162 @@
+"""Apply channel membership changes to Slack.
+
+Invites are sent in chunks of up to Slack's per-call maximum and every channel is
+worked on at once, with each call going through the shared rate limiter. When Slack
+rejects some of the users in a batch those users are recorded and the rest of the
+batch is retried, so one bad ID no longer sinks a whole channel. Anything that isn't
+about a particular user (auth, scopes, rate limits, Slack being down) fails the
+channel straight away rather than being retried user by user. The users that were
+already changed by then are attached to the error as its done list.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any
+
+from slack_sdk.errors import SlackApiError
+
+import rate_limit
+
+# conversations.invite accepts up to 1000 users per call
+INVITE_CHUNK = 1000
+
+# Errors that mean the user is already where we want them
+ALREADY_INVITED = {"already_in_channel"}
+ALREADY_KICKED = {"not_in_channel"}
+
+# Errors about a particular user, the only ones worth splitting a batch over
+INVITE_USER_ERRORS = {
+    "already_in_channel",
+    "cant_invite",
+    "cant_invite_self",
+    "user_is_restricted",
+    "user_is_ultra_restricted",
+    "user_not_found",
+    "ura_max_channels",
+}
+KICK_USER_ERRORS = {"cant_kick_self", "not_in_channel", "user_not_found"}
+
+
+def _invite(
+    client, channel: str, users: list[str], failed: dict[str, str], done: list[str]
+) -> None:
+    try:
+        rate_limit.scheduler().slack(
+            client, "conversations_invite", channel=channel, users=",".join(users)
+        )
+        done.extend(users)
+        return
+    except SlackApiError as e:
+        error = e.response["error"]
+        per_user = {
+            err["user"]: err["error"]
+            for err in e.response.get("errors", [])
+            if isinstance(err, dict) and "user" in err
+        }
+        # Splitting the batch won't help with tokens, scopes, the channel itself or
+        # Slack having problems
+        if not per_user and error not in INVITE_USER_ERRORS:
+            raise
+
+    if per_user:
+        for user, user_error in per_user.items():
+            if user_error in ALREADY_INVITED:
+                done.append(user)
+            else:
+                failed[user] = user_error
+        rest = [user for user in users if user not in per_user]
+        if rest:
+            _invite(client, channel, rest, failed, done)
+    elif len(users) == 1:
+        if error in ALREADY_INVITED:
+            done.append(users[0])
+        else:
+            failed[users[0]] = error
+    else:
+        # Slack didn't tell us who was the problem so narrow it down
+        middle = len(users) // 2
+        _invite(client, channel, users[:middle], failed, done)
+        _invite(client, channel, users[middle:], failed, done)
+
+
+def invite_users(client, channel: str, users: list[str]) -> dict[str, str]:
+    """Invite users to a channel, returning the ones that failed and why"""
+    failed: dict[str, str] = {}
+    done: list[str] = []
+    try:
+        for i in range(0, len(users), INVITE_CHUNK):
+            _invite(client, channel, users[i : i + INVITE_CHUNK], failed, done)
+    except SlackApiError as e:
+        e.done = done  # type: ignore[attr-defined]
+        raise
+    return failed
+
+
+def kick_users(client, channel: str, users: list[str]) -> dict[str, str]:
+    """Remove users from a channel one at a time (the API only takes one), returning failures"""
+    failed: dict[str, str] = {}
+    done: list[str] = []
+    for user in users:
+        try:
+            rate_limit.scheduler().slack(
+                client, "conversations_kick", channel=channel, user=user
+            )
+        except SlackApiError as e:
+            if e.response["error"] not in KICK_USER_ERRORS:
+                e.done = done  # type: ignore[attr-defined]
+                raise
+            if e.response["error"] not in ALREADY_KICKED:
+                failed[user] = e.response["error"]
+                continue
+        done.append(user)
+    return failed
+
+
+def apply(
+    client,
+    invites: dict[str, list[str]],
+    kicks: dict[str, list[str]] | None = None,
+    workers: int = 4,
+) -> dict[str, dict[str, Any]]:
+    """Work through every channel concurrently
+
+    Returns a result per channel with the users that were added/removed, the ones that
+    failed, and an error if the channel as a whole couldn't be changed.
+    """
+    kicks = kicks or {}
+    results: dict[str, dict[str, Any]] = {
+        channel: {"invited": [], "kicked": [], "failed": {}, "error": None}
+        for channel in list(invites) + list(kicks)
+    }
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for channel, users in invites.items():
+            futures[pool.submit(invite_users, client, channel, users)] = (
+                channel,
+                "invited",
+                users,
+            )
+        for channel, users in kicks.items():
+            futures[pool.submit(kick_users, client, channel, users)] = (
+                channel,
+                "kicked",
+                users,
+            )
+        for future in as_completed(futures):
+            channel, action, users = futures[future]
+            try:
+                failed = future.result()
+            except SlackApiError as e:
+                logging.error(f"Error updating #{channel}: {e.response['error']}")
+                results[channel]["error"] = e.response["error"]
+                # Anyone changed before the error was still changed
+                results[channel][action].extend(getattr(e, "done", []))
+                continue
+            done = [user for user in users if user not in failed]
+            results[channel][action].extend(done)
+            results[channel]["failed"].update(failed)
+            logging.info(f"{action.capitalize()} {len(done)} for #{channel}")
+            for user, error in failed.items():
+                logging.warning(f"Could not update {user} in #{channel}: {error}")
+    return results
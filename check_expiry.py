@@ -1,19 +1,40 @@
 import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+
+import numpy as np
 import requests
 from pprint import pprint
 from datetime import datetime, timedelta
-import time
+
+import group_journal
+import membership_table
+import rate_limit
+import tidyhq
+
+# Check for --debug flag
+if len(sys.argv) > 1 and "--debug" in sys.argv:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
 
 # Load config
 with open("config.json") as f:
     config = json.load(f)
 
 webhook_url = config["slack"]["webhook"]["url"]
-token = config["tidyhq"]["token"]
-contacts_url = "https://api.tidyhq.com/v1/contacts"
-membership_url = "https://api.tidyhq.com/v1/membership_levels/{}/memberships"
-contact_membership_url = "https://api.tidyhq.com/v1/contacts/{}/memberships"
-change_group_url = "https://api.tidyhq.com/v1/groups/{}/contacts/{}"
+tidy = tidyhq.client(config)
+limiter = rate_limit.scheduler()
+journal = group_journal.journal(config)
+contacts_url = "contacts"
+membership_url = "membership_levels/{}/memberships"
+contact_membership_url = "contacts/{}/memberships"
+change_group_url = "groups/{}/contacts/{}"
+
+# How many membership levels to fetch at once
+LEVEL_WORKERS = 8
 
 group_pairs = []
 group_pairs.append([9282, [9283], 2139, "band"])  # band
@@ -21,12 +42,35 @@ group_pairs.append([2069, [4958, 2368], 428, "concession"])  # concession
 group_pairs.append([2077, [4957, 99624], 427, "full"])  # full
 
 
+@cache
 def get_contact(id):
-    r = requests.get(contacts_url + "/" + str(id), params={"access_token": token})
-    member = r.json()
+    member = tidy.get(contacts_url + "/" + str(id))
     return member
 
 
+def get_levels():
+    """IDs of every membership level in TidyHQ, less any in tidyhq/ids/expiry_ignore_levels"""
+    ignore = {str(l) for l in config["tidyhq"]["ids"].get("expiry_ignore_levels", [])}
+    return [
+        str(level["id"])
+        for level in tidyhq.membership_levels(config)
+        if str(level["id"]) not in ignore
+    ]
+
+
+def get_level_memberships(level_ids):
+    """Memberships for every level, fetched in parallel"""
+
+    def fetch(level_id):
+        return limiter.call("tidyhq", tidy.get, membership_url.format(level_id))
+
+    memberships = []
+    with ThreadPoolExecutor(max_workers=LEVEL_WORKERS) as pool:
+        for level_memberships in pool.map(fetch, level_ids):
+            memberships.extend(level_memberships)
+    return memberships
+
+
 def get_groups(contact):
     g = []
     for group in contact["groups"]:
@@ -35,8 +79,7 @@ def get_groups(contact):
 
 
 def get_memberships(id, raw=False):
-    r = requests.get(contact_membership_url.format(id), params={"access_token": token})
-    memberships = r.json()
+    memberships = tidy.get(contact_membership_url.format(id))
     if raw == True:
         return memberships
     m = []
@@ -45,14 +88,10 @@ def get_memberships(id, raw=False):
     return m
 
 
+# Group changes are journaled and sent by journal.drain() at the end of the run
 def rm_from_group(group_id, contact_id):
-    r = requests.delete(
-        change_group_url.format(group_id, contact_id), params={"access_token": token}
-    )
-    time.sleep(1)
-    if r.status_code == 204:
-        return True
-    return False
+    journal.remove(group_id, contact_id)
+    return True
 
 
 def add_to_group(contact_id, group_ids, since):
@@ -63,38 +102,12 @@ def add_to_group(contact_id, group_ids, since):
         group_id = group_ids[0]
     else:
         group_id = group_ids[-1]
-    r = requests.put(
-        change_group_url.format(group_id, contact_id), params={"access_token": token}
-    )
-    time.sleep(1)
-    if r.status_code == 204:
-        return True
-    return False
-
-
-def time_since_membership(memberships):
-    newest = 60000
-    for membership in memberships:
-        try:
-            date = datetime.strptime(membership["end_date"], "%Y-%m-%d")
-        except ValueError:
-            try:
-                date = datetime.strptime(membership["end_date"][:10], "%d-%m-%Y")
-            except ValueError:
-                try:
-                    date = datetime.strptime(membership["end_date"][:10], "%Y-%m-%d")
-                except ValueError:
-                    print("Tried both d-m-y and y-m-d ")
-                    print(membership["end_date"])
-                    print(type(membership["end_date"]))
-        since = int((datetime.now() - date).total_seconds() / 86400)
-        if since < newest:
-            newest = int(since)
-    return newest
+    journal.add(group_id, contact_id)
+    return True
 
 
 def notify_slack(contact_id, days, alarm=False):
-    member = get_contact(contact_id)
+    member = contacts.by_id.get(str(contact_id)) or get_contact(contact_id)
     billing_group = " (No billing group)"
     for group in member["groups"]:
         if "Billing" in group["label"]:
@@ -116,13 +129,36 @@ def notify_slack(contact_id, days, alarm=False):
     )
 
 
-for id in ["427", "428", "2139", "8208", "8285", "10465", "11479", "18830"]:
-    r = requests.get(membership_url.format(id), params={"access_token": token})
-    memberships = r.json()
-    for membership in memberships:
-        since = time_since_membership([membership])
-        if since < 0 and since > -3:
-            print(membership["contact_id"])
-            notify_slack(membership["contact_id"], str(since * -1))
-        elif since == 0:
-            notify_slack(membership["contact_id"], str(since), alarm=True)
+levels = get_levels()
+logging.debug(f"Checking {len(levels)} membership levels")
+memberships = get_level_memberships(levels)
+
+# Every contact we might notify about comes from the shared snapshot in one go
+contacts = tidyhq.index(config)
+
+# Someone can have memberships under several levels (or a renewal alongside the one
+# that's ending) so only when their last one ends counts. One that never ends always wins.
+# Ends are compared as dates, a timestamp late in the day shouldn't push a warning
+# or alarm out by a day.
+index = membership_table.IntervalIndex(
+    membership_table.MembershipTable(memberships), end_unit="D"
+)
+now = membership_table.as_datetime64()
+day = np.timedelta64(1, "D")
+
+# Ending in one or two days
+for contact_id, end in index.ending_between(now + day, now + 3 * day).items():
+    print(contact_id)
+    notify_slack(contact_id, str(int((end - now) // day)))
+
+# Ending within a day either side of now
+for contact_id in index.ending_between(now - day + np.timedelta64(1, "s"), now + day):
+    notify_slack(contact_id, "0", alarm=True)
+
+# Send any group changes, including ones an earlier run didn't get to
+if journal.pending():
+    results = journal.drain()
+    logging.info(
+        f"Group changes: {results['done']} done, {results['retrying']} waiting to retry, {results['failed']} failed"
+    )
+journal.close()
@@ -1,56 +1,177 @@
+import hashlib
 import json
 import logging
+import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pprint import pprint
 from typing import Any
 
 import requests
 
 import errors
-
-
-def correct_name(name: str) -> str:
-    # Takes a name and returns a version with the first letter capitalised and whitespace trimmed
-
-    if not name:
-        return name
-
-    fixed_name = ""
-
-    for word in name.split():
-        # This will strip whitespace
-        if word:
-            # Capitalise the first letter of the word but leave the rest of the word alone
-            word = word[0].upper() + word[1:]
-
-            # Special case for Mc
-            if word.startswith("Mc") and len(word) > 2:
-                word = word[:2] + word[2].upper() + word[3:]
-
-            # special case for Mac
-            if word.startswith("Mac") and len(word) > 6:
-                word = word[:3] + word[3].upper() + word[4:]
-
-            # Special case for '
-            if "'" in word:
-                word = (
-                    word[: word.index("'") + 1]
-                    + word[word.index("'") + 1].upper()
-                    + word[word.index("'") + 2 :]
-                )
-
-            # Special case for hyphenated names
-            if "-" in word:
-                word = (
-                    word[: word.index("-") + 1]
-                    + word[word.index("-") + 1].upper()
-                    + word[word.index("-") + 2 :]
-                )
-
-            fixed_name += word + " "
-
-    return fixed_name.strip()
+import helpers
+import name_normaliser
+import rate_limit
+import tidyhq
+
+# Corrections that TidyHQ rejected on the last run
+FAILURES_PATH = "tidyhq_correction_failures.json"
+
+# What each contact's names looked like when we last checked them and what they needed
+FINGERPRINTS_PATH = "tidyhq_correction_fingerprints.json"
+
+# Bump whenever get_corrections() or name_normaliser.RULES changes so stored results get rechecked
+RULES_VERSION = 2
+
+FINGERPRINT_FIELDS = ["kind", "first_name", "last_name", "nick_name"]
+
+
+def get_corrections(contact: dict[str, Any], names: dict[str, str]) -> dict[str, str]:
+    """Every change a contact needs, empty if it's fine. names holds the normalised first/last names."""
+    corrections: dict[str, str] = {}
+
+    # Check if contact is a person
+    if contact["kind"] != "person":
+        return corrections
+
+    # Check if names are capitalised
+    for field in ["first_name", "last_name"]:
+        corrected = names[field]
+        if contact[field] != corrected:
+            corrections[field] = corrected
+
+    # Check if their nickname is just their first name
+    if (
+        isinstance(contact["nick_name"], str)
+        and contact["nick_name"] != ""
+        and isinstance(contact["first_name"], str)
+        and contact["first_name"] != ""
+    ):
+        if contact["nick_name"].lower() == contact["first_name"].lower():
+            corrections["nick_name"] = ""
+
+    # Check if their nickname has whitespace at the end
+    if (
+        isinstance(contact["nick_name"], str)
+        and contact["nick_name"] != ""
+        and contact["nick_name"].endswith(" ")
+        and "nick_name" not in corrections
+    ):
+        corrections["nick_name"] = contact["nick_name"].strip()
+
+    return corrections
+
+
+def fingerprint(contact: dict[str, Any]) -> str:
+    """Hash of everything get_corrections() looks at"""
+    fields = json.dumps([contact.get(field) for field in FINGERPRINT_FIELDS])
+    return hashlib.sha1(fields.encode()).hexdigest()
+
+
+def load_fingerprints() -> dict[str, Any]:
+    """The last run's fingerprints, or an empty store if they're missing or from older rules"""
+    try:
+        with open(FINGERPRINTS_PATH, "r") as f:
+            store = json.load(f)
+    except FileNotFoundError:
+        return {"checked_at": 0, "contacts": {}}
+    except ValueError:
+        logging.warning(f"Ignoring unreadable fingerprint store {FINGERPRINTS_PATH}")
+        return {"checked_at": 0, "contacts": {}}
+    if store.get("rules") != RULES_VERSION:
+        logging.info(
+            "Correction rules have changed since the last run, rechecking everyone"
+        )
+        return {"checked_at": 0, "contacts": {}}
+    return store
+
+
+def save_fingerprints(store: dict[str, Any]) -> None:
+    store["rules"] = RULES_VERSION
+    helpers.write_json(FINGERPRINTS_PATH, store)
+
+
+def changed_contacts(store: dict[str, Any], full: bool) -> list[dict[str, Any]]:
+    """Contacts that might have changed since the last check, everyone on a full run"""
+    if full:
+        # A fresh dump rather than the snapshot, which never drops deleted contacts
+        logging.debug("Checking every contact")
+        snapshot = tidyhq.snapshot(config)
+        snapshot.refresh(full=True)
+        return list(snapshot.contacts.values())
+    if not store["contacts"]:
+        logging.debug("Checking every contact")
+        return tidyhq.contacts(config)
+    since = datetime.fromtimestamp(
+        store["checked_at"] - tidyhq.UPDATE_OVERLAP, tz=timezone.utc
+    ).strftime("%Y-%m-%dT%H:%M:%SZ")
+    logging.debug(f"Checking contacts changed since {since}")
+    return tidyhq.client(config).contacts(updated_since=since)
+
+
+def correct_contact(
+    contact_id: str, contact_corrections: dict[str, str]
+) -> tuple[int | None, str | None]:
+    """Send one contact's corrections to TidyHQ, returning the status and an error if it didn't work"""
+    try:
+        r = rate_limit.scheduler().tidyhq(
+            tidyhq.client(config).put,
+            f"contacts/{contact_id}",
+            params=contact_corrections,
+        )
+    except requests.exceptions.RequestException as e:
+        return None, str(e)
+    if r.status_code != 200:
+        return r.status_code, f"{r.status_code} {r.text[:200]}"
+    return r.status_code, None
+
+
+def apply_corrections(
+    approved: dict[str, dict[str, str]],
+) -> tuple[dict[str, str], set[str]]:
+    """Send corrections in parallel within the shared TidyHQ rate limit
+
+    Returns the failures and the contacts that no longer exist.
+    """
+    failures: dict[str, str] = {}
+    gone: set[str] = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(correct_contact, contact_id, contact_corrections): contact_id
+            for contact_id, contact_corrections in approved.items()
+        }
+        for future in as_completed(futures):
+            contact_id = futures[future]
+            status, error = future.result()
+            if status == 404:
+                logging.info(f"Contact {contact_id} has been deleted, forgetting it")
+                gone.add(contact_id)
+            elif error:
+                logging.error(f"Failed to update contact {contact_id}: {error}")
+                failures[contact_id] = error
+            else:
+                logging.debug(f"Corrected contact {contact_id}: {approved[contact_id]}")
+    return failures, gone
+
+
+def save_failures(failures: dict[str, str], approved: dict[str, dict[str, str]]):
+    """Keep a record of what didn't go through, or clear the last one"""
+    if not failures:
+        if os.path.exists(FAILURES_PATH):
+            os.remove(FAILURES_PATH)
+        return
+    helpers.write_json(
+        FAILURES_PATH,
+        {
+            contact_id: {"corrections": approved[contact_id], "error": error}
+            for contact_id, error in failures.items()
+        },
+        indent=4,
+    )
+    logging.info(f"Failed corrections written to {FAILURES_PATH}")
 
 
 # Check for --debug flag and set logging level accordingly
@@ -64,111 +185,99 @@ with open("config.json", "r") as f:
     config: dict[str, Any] = json.load(f)
 
 # Get TidyHQ org name for URLs.
-domain: str = requests.get(
-    "https://api.tidyhq.com/v1/organization",
-    params={"access_token": config["tidyhq"]["token"]},
-).json()["domain_prefix"]
+domain: str = tidyhq.client(config).domain()
+
 
+# Check for --full flag, recheck every contact rather than just the ones that changed
+full = "--full" in sys.argv
+store = load_fingerprints()
+started = time.time()
 
-logging.debug("Attempting to get contact dump from TidyHQ...")
+logging.debug("Attempting to get contacts from TidyHQ...")
 try:
-    r = requests.get(
-        "https://api.tidyhq.com/v1/contacts",
-        params={"access_token": config["tidyhq"]["token"]},
-    )
-    contacts: list[dict[str, Any]] = r.json()
+    contacts: list[dict[str, Any]] = changed_contacts(store, full)
     logging.info(f"Got {len(contacts)} contacts from TidyHQ")
 except requests.exceptions.RequestException:
     logging.error(errors.tidyhq_connect)
     sys.exit(1)
 
+# A full pass sees every contact, so anything else in the store has been deleted
+if full:
+    fetched = {str(contact["id"]) for contact in contacts}
+    store["contacts"] = {
+        contact_id: stored
+        for contact_id, stored in store["contacts"].items()
+        if contact_id in fetched
+    }
+
+# Check for --workers=N, how many corrections can be in flight at once
+workers = helpers.workers_arg()
+
+# Only contacts whose names changed since we last looked need checking again
+to_check = []
+for contact in contacts:
+    contact_fingerprint = fingerprint(contact)
+    previous = store["contacts"].get(str(contact["id"]))
+    if not previous or previous["fingerprint"] != contact_fingerprint:
+        to_check.append((contact, contact_fingerprint))
+
+# Normalise every first and last name in one batch
+normalised = name_normaliser.normalise_names(
+    [contact[field] for contact, _ in to_check for field in ["first_name", "last_name"]]
+)
+for i, (contact, contact_fingerprint) in enumerate(to_check):
+    names = {"first_name": normalised[2 * i], "last_name": normalised[2 * i + 1]}
+    store["contacts"][str(contact["id"])] = {
+        "fingerprint": contact_fingerprint,
+        "display_name": contact["display_name"],
+        "corrections": get_corrections(contact, names),
+    }
+logging.info(f"Checked {len(to_check)} new or changed contacts")
+
+# Work out every correction before changing anything, including ones that were
+# skipped or failed last time
+corrections = {
+    contact_id: stored["corrections"]
+    for contact_id, stored in store["contacts"].items()
+    if stored["corrections"]
+}
+logging.info(f"{len(corrections)} contacts need corrections")
+
 # Check for --cron flag
 if "--cron" in sys.argv:
     logging.info("Running in cron mode")
-
-    # Iterate over each contact
-    for contact in contacts:
-        corrections: dict[str, str] = {}
-
-        # Check if contact is a person
-        if contact["kind"] != "person":
-            continue
-
-        # Check if names are capitalised
-        for field in ["first_name", "last_name"]:
-            if contact[field] != correct_name(contact[field]):
-                corrections[field] = correct_name(contact[field])
-
-        # Check if their nickname is just their first name
-        if (
-            isinstance(contact["nick_name"], str)
-            and contact["nick_name"] != ""
-            and isinstance(contact["first_name"], str)
-            and contact["first_name"] != ""
-        ):
-            if contact["nick_name"].lower() == contact["first_name"].lower():
-                corrections["nick_name"] = ""
-
-        # Check if their nickname has whitespace at the end
-        if (
-            isinstance(contact["nick_name"], str)
-            and contact["nick_name"] != ""
-            and contact["nick_name"].endswith(" ")
-        ):
-            corrections["nick_name"] = contact["nick_name"].strip()
-
-        if corrections:
-            # send corrected data to TidyHQ
-            r = requests.put(
-                f"https://api.tidyhq.com/v1/contacts/{contact['id']}",
-                params={"access_token": config["tidyhq"]["token"]} | corrections,
-            )
-            time.sleep(1)
+    approved = corrections
 
 else:
-    # Iterate over each contact
-    for contact in contacts:
-        corrections: dict[str, str] = {}
-
-        # Check if contact is a person
-        if contact["kind"] != "person":
+    approved = {}
+    for contact_id, contact_corrections in corrections.items():
+        # Print corrections
+        print(
+            f"Contact {contact_id} ({store['contacts'][contact_id]['display_name']}) needs corrections:"
+        )
+        pprint(contact_corrections)
+
+        # Ask user if they want to apply corrections
+        if input("Apply corrections? (Y/n) ").lower() == "n":
             continue
-
-        # Check if names are capitalised
-        for field in ["first_name", "last_name"]:
-            if contact[field] != correct_name(contact[field]):
-                pprint(contact[field])
-                corrections[field] = correct_name(contact[field])
-
-        # Check if their nickname is just their first name
-        if (
-            isinstance(contact["nick_name"], str)
-            and contact["nick_name"] != ""
-            and isinstance(contact["first_name"], str)
-            and contact["first_name"] != ""
-        ):
-            if contact["nick_name"].lower() == contact["first_name"].lower():
-                corrections["nick_name"] = ""
-
-        if corrections:
-            # Print corrections
-            print(f"Contact {contact['id']} needs corrections:")
-            pprint(corrections)
-
-            # Ask user if they want to apply corrections
-            if input("Apply corrections? (Y/n) ").lower() == "n":
-                continue
-
-            # send corrected data to TidyHQ
-            r = requests.put(
-                f"https://api.tidyhq.com/v1/contacts/{contact['id']}",
-                params={"access_token": config["tidyhq"]["token"]} | corrections,
-            )
-
-            # Check if the update was successful
-            if r.status_code == 200:
-                print(
-                    f'Name corrected for contact {contact["id"]}: {contact["display_name"]}'
-                )
-            else:
-                print(f"Failed to update contact {contact['id']}: {r.text}")
+        approved[contact_id] = contact_corrections
+
+failures, gone = apply_corrections(approved)
+logging.info(
+    f"Corrected {len(approved) - len(failures) - len(gone)} of {len(approved)} contacts, {len(failures)} failed, {len(gone)} no longer exist"
+)
+for contact_id, error in failures.items():
+    logging.warning(f"  https://{domain}.tidyhq.com/contacts/{contact_id}: {error}")
+save_failures(failures, approved)
+
+# Corrected contacts come back through updated_since next time and get a fresh fingerprint
+for contact_id in approved:
+    if contact_id in gone:
+        del store["contacts"][contact_id]
+    elif contact_id not in failures:
+        store["contacts"][contact_id]["corrections"] = {}
+store["checked_at"] = started
+save_fingerprints(store)
+
+# We've (probably) changed contacts so make sure the next script picks them up
+tidyhq.expire_snapshot(config)
@@ -4,6 +4,8 @@ from pprint import pprint
 from datetime import datetime
 import sys
 
+import tidyhq
+
 with open("config.json", "r") as f:
     config = json.load(f)
 with open("events.json", "r") as f:
@@ -13,10 +15,7 @@ with open("events.json", "r") as f:
 def get_event(event_id: str = ""):
     if event_id:
         try:
-            r = requests.get(
-                f"https://api.tidyhq.com/v1/events/{event_id}",
-                params={"access_token": config["tidyhq"]["token"]},
-            )
+            r = tidyhq.client(config).request("GET", f"events/{event_id}")
             if r.status_code == 200:
                 event = r.json()
                 return event
@@ -28,10 +27,7 @@ def get_event(event_id: str = ""):
 def get_tickets(event_id: str = ""):
     if event_id:
         try:
-            r = requests.get(
-                f"https://api.tidyhq.com/v1/events/{event_id}/tickets/",
-                params={"access_token": config["tidyhq"]["token"]},
-            )
+            r = tidyhq.client(config).request("GET", f"events/{event_id}/tickets/")
             if r.status_code == 200:
                 tickets = r.json()
                 return tickets
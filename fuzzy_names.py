@@ -0,0 +1,200 @@
+"""Suggest Slack users for TidyHQ contacts by how similar their names are.
+
+Names are broken into character trigrams, hashed into a fixed number of dimensions
+and weighted by how rare each trigram is, so every name becomes a unit vector and
+cosine similarity is a matrix product. Queries are scored against every indexed name
+in blocks to keep memory flat, keeping only the top few candidates per query.
+"""
+
+import random
+import sys
+import time
+import zlib
+
+import numpy as np
+
+# Trigrams hashed into this many dimensions, collisions cost a little accuracy but
+# keep 20k x 20k comparisons to a few seconds
+DIMS = 512
+NGRAM = 3
+
+# Queries scored at once, each block needs BLOCK x indexed names floats
+BLOCK = 1024
+
+
+def ngrams(name: str, n: int = NGRAM) -> list[str]:
+    """Character n-grams of a name, padded so word starts and ends count"""
+    name = " ".join(name.lower().split())
+    if not name:
+        return []
+    padded = f" {name} "
+    return [padded[i : i + n] for i in range(max(1, len(padded) - n + 1))]
+
+
+def _hashed(names: list[str], dims: int) -> np.ndarray:
+    """Raw trigram counts, one row per name"""
+    rows: list[int] = []
+    cols: list[int] = []
+    for row, name in enumerate(names):
+        for gram in ngrams(name):
+            rows.append(row)
+            cols.append(zlib.crc32(gram.encode()) % dims)
+    counts = np.zeros((len(names), dims), dtype=np.float32)
+    np.add.at(counts, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), 1)
+    return counts
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class NameIndex:
+    """Unit vectors for everyone's names, a person can have several (real and display name)"""
+
+    def __init__(self, names: dict[str, list[str]], dims: int = DIMS) -> None:
+        self.dims = dims
+        self.ids = list(names)
+        first = [(names[i][0] if names[i] else "") or "" for i in self.ids]
+        raw = _hashed(first, dims)
+
+        # Other names (display names etc) are only kept for the people that have a
+        # different one, most don't so this saves scoring the same name twice
+        extra: list[tuple[np.ndarray, np.ndarray]] = []
+        variants = max((len(v) for v in names.values()), default=1)
+        for v in range(1, variants):
+            rows = [
+                row
+                for row, i in enumerate(self.ids)
+                if v < len(names[i])
+                and names[i][v]
+                and names[i][v].lower() not in {n.lower() for n in names[i][:v] if n}
+            ]
+            if rows:
+                counts = _hashed([names[self.ids[row]][v] for row in rows], dims)
+                extra.append((np.array(rows, dtype=np.intp), counts))
+
+        # Rare trigrams say more about who someone is than common ones
+        present = (raw > 0).sum(axis=0).astype(np.float32)
+        documents = len(self.ids)
+        for _, counts in extra:
+            present += (counts > 0).sum(axis=0)
+            documents += len(counts)
+        self.idf = np.log((1 + documents) / (1 + present)).astype(np.float32) + 1
+        # Extra names become extra columns, owners maps each column back to a person
+        self.vectors = _normalise(
+            np.vstack([raw] + [counts for _, counts in extra]) * self.idf
+        )
+        self.owners = np.concatenate(
+            [np.arange(len(self.ids), dtype=np.intp)] + [rows for rows, _ in extra]
+        )
+        self.extra_names = len(self.owners) - len(self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def encode(self, names: list[str]) -> np.ndarray:
+        return _normalise(_hashed(names, self.dims) * self.idf)
+
+    def suggest(
+        self, queries: dict[str, str], k: int = 3, block: int = BLOCK
+    ) -> dict[str, list[tuple[str, float]]]:
+        """The k most similar indexed people for each query, best first"""
+        query_ids = list(queries)
+        results: dict[str, list[tuple[str, float]]] = {}
+        if not query_ids or not self.ids:
+            return {query_id: [] for query_id in query_ids}
+        k = min(k, len(self.ids))
+        # Someone can fill up to two of the top slots with different names
+        wanted = min(k * 2 if self.extra_names else k, len(self.owners))
+        encoded = self.encode([queries[query_id] or "" for query_id in query_ids])
+
+        for start in range(0, len(query_ids), block):
+            scores = encoded[start : start + block] @ self.vectors.T
+
+            # Partition for the top candidates then only sort those
+            top = np.argpartition(scores, -wanted, axis=1)[:, -wanted:]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = self.owners[np.take_along_axis(top, order, axis=1)]
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            for row, query_id in enumerate(query_ids[start : start + block]):
+                best: dict[str, float] = {}
+                for column, score in zip(top[row], top_scores[row]):
+                    if score > 0 and len(best) < k:
+                        best.setdefault(self.ids[column], float(score))
+                results[query_id] = list(best.items())
+        return results
+
+
+def confident(
+    suggestions: dict[str, list[tuple[str, float]]], threshold: float
+) -> dict[str, tuple[str, float]]:
+    """Suggestions good enough to act on without asking
+
+    The best candidate has to clear the threshold, the runner up must not, and no other
+    query can have picked the same person.
+    """
+    picked: dict[str, tuple[str, float]] = {}
+    chosen_by: dict[str, list[str]] = {}
+    for query_id, candidates in suggestions.items():
+        if not candidates or candidates[0][1] < threshold:
+            continue
+        if len(candidates) > 1 and candidates[1][1] >= threshold:
+            continue
+        picked[query_id] = candidates[0]
+        chosen_by.setdefault(candidates[0][0], []).append(query_id)
+    return {
+        query_id: candidate
+        for query_id, candidate in picked.items()
+        if len(chosen_by[candidate[0]]) == 1
+    }
+
+
+def benchmark(queries: int = 20000, people: int = 20000) -> None:
+    """Time suggest() against synthetic names"""
+    random.seed(1)
+    syllables = ["an", "bel", "cor", "dan", "el", "fi", "gra", "ha", "is", "jo", "ka"]
+    syllables += ["li", "mar", "ne", "o", "pe", "qui", "ro", "sa", "tom", "u", "vi"]
+
+    def name() -> str:
+        return " ".join(
+            "".join(random.choices(syllables, k=random.randint(2, 4))).title()
+            for _ in range(2)
+        )
+
+    # Most Slack users don't set a display name that differs from their real name
+    names = {
+        f"U{i}": [name(), name() if random.random() < 0.3 else ""]
+        for i in range(people)
+    }
+    # Every query is a lightly mangled copy of someone's real name
+    targets = random.sample(list(names), min(queries, people))
+    query_names = {}
+    for i, target in enumerate(targets):
+        real = names[target][0]
+        cut = random.randrange(len(real))
+        query_names[str(i)] = real[:cut] + real[cut + 1 :]
+
+    started = time.perf_counter()
+    index = NameIndex(names)
+    built = time.perf_counter()
+    suggestions = index.suggest(query_names)
+    finished = time.perf_counter()
+
+    hits = sum(
+        1
+        for i, target in enumerate(targets)
+        if suggestions[str(i)] and suggestions[str(i)][0][0] == target
+    )
+    print(
+        f"{len(query_names)} x {people}: index {built - started:.2f}s, "
+        f"suggest {finished - built:.2f}s, top match correct {hits / len(targets):.1%}"
+    )
+
+
+if __name__ == "__main__":
+    # python fuzzy_names.py [queries] [people]
+    benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,185 @@
+"""Durable queue of TidyHQ group changes.
+
+Group adds/removes are written to a small SQLite journal before anything is sent so
+a run that dies halfway leaves a record of what it still meant to do. drain() works
+through everything outstanding (including anything left by earlier runs) in
+parallel under the shared TidyHQ rate limit, retrying failures with exponential
+backoff. Both operations are safe to repeat so a retry after a lost response does
+no harm, and finished operations are never sent again.
+"""
+
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any
+
+import requests
+
+import rate_limit
+import tidyhq
+
+JOURNAL_PATH = "tidyhq_group_journal.sqlite3"
+
+CHANGE_GROUP_URL = "groups/{}/contacts/{}"
+
+# Give up on an operation after this many attempts, it stays in the journal as failed
+MAX_ATTEMPTS = 8
+BACKOFF = 2
+MAX_BACKOFF = 15 * 60
+
+# How long drain() will wait for retries to come due before leaving them for next run
+MAX_WAIT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    contact_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS pending_operation
+    ON operations (action, group_id, contact_id) WHERE status = 'pending';
+"""
+
+
+class GroupJournal:
+    def __init__(self, client: tidyhq.TidyHQ, path: str = JOURNAL_PATH) -> None:
+        self.client = client
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _queue(self, action: str, group_id: Any, contact_id: Any) -> None:
+        opposite = "remove" if action == "add" else "add"
+        with self.db:
+            # The latest change wins, so an unsent opposite change would only race it
+            self.db.execute(
+                "UPDATE operations SET status = 'superseded', finished = ?"
+                " WHERE status = 'pending' AND action = ? AND group_id = ?"
+                " AND contact_id = ?",
+                (time.time(), opposite, str(group_id), str(contact_id)),
+            )
+            # Queueing the same change twice before it's been sent is a no-op
+            self.db.execute(
+                "INSERT OR IGNORE INTO operations (action, group_id, contact_id, created)"
+                " VALUES (?, ?, ?, ?)",
+                (action, str(group_id), str(contact_id), time.time()),
+            )
+
+    def add(self, group_id: Any, contact_id: Any) -> None:
+        self._queue("add", group_id, contact_id)
+
+    def remove(self, group_id: Any, contact_id: Any) -> None:
+        self._queue("remove", group_id, contact_id)
+
+    def pending(self) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM operations WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def _send(self, action: str, group_id: str, contact_id: str) -> str | None:
+        """Make one change, returning an error or None if the contact ended up where we want"""
+        limiter = rate_limit.scheduler()
+        url = CHANGE_GROUP_URL.format(group_id, contact_id)
+        try:
+            if action == "add":
+                r = limiter.tidyhq(self.client.put, url)
+            else:
+                r = limiter.tidyhq(self.client.delete, url)
+        except requests.exceptions.RequestException as e:
+            return str(e)
+        # Already removed is as good as removed
+        if r.status_code in (200, 204) or (action == "remove" and r.status_code == 404):
+            return None
+        return f"{r.status_code} {r.text[:200]}"
+
+    def _finish(self, op_id: int, attempts: int, error: str | None) -> None:
+        now = time.time()
+        with self.db:
+            if error is None:
+                self.db.execute(
+                    "UPDATE operations SET status = 'done', attempts = ?, finished = ?,"
+                    " last_error = NULL WHERE id = ?",
+                    (attempts, now, op_id),
+                )
+            elif attempts >= MAX_ATTEMPTS:
+                self.db.execute(
+                    "UPDATE operations SET status = 'failed', attempts = ?, finished = ?,"
+                    " last_error = ? WHERE id = ?",
+                    (attempts, now, error, op_id),
+                )
+            else:
+                delay = min(MAX_BACKOFF, BACKOFF**attempts)
+                self.db.execute(
+                    "UPDATE operations SET attempts = ?, next_attempt = ?, last_error = ?"
+                    " WHERE id = ?",
+                    (attempts, now + delay, error, op_id),
+                )
+
+    def drain(self, workers: int = 4, max_wait: float = MAX_WAIT) -> dict[str, int]:
+        """Send everything outstanding, returning how many operations finished each way"""
+        results = {"done": 0, "retrying": 0, "failed": 0}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                now = time.time()
+                due = self.db.execute(
+                    "SELECT id, action, group_id, contact_id, attempts FROM operations"
+                    " WHERE status = 'pending' AND next_attempt <= ? ORDER BY id",
+                    (now,),
+                ).fetchall()
+                if not due:
+                    upcoming = self.db.execute(
+                        "SELECT MIN(next_attempt) FROM operations WHERE status = 'pending'"
+                    ).fetchone()[0]
+                    if upcoming is None or upcoming - now > max_wait:
+                        break
+                    time.sleep(max(0, upcoming - now))
+                    continue
+
+                futures = {
+                    pool.submit(self._send, action, group_id, contact_id): (
+                        op_id,
+                        action,
+                        group_id,
+                        contact_id,
+                        attempts + 1,
+                    )
+                    for op_id, action, group_id, contact_id, attempts in due
+                }
+                # Only this thread touches the database
+                for future in as_completed(futures):
+                    op_id, action, group_id, contact_id, attempts = futures[future]
+                    error = future.result()
+                    self._finish(op_id, attempts, error)
+                    if error is None:
+                        logging.info(f"{action} contact {contact_id} group {group_id}")
+                        results["done"] += 1
+                    elif attempts >= MAX_ATTEMPTS:
+                        logging.error(
+                            f"Giving up on {action} contact {contact_id} group {group_id}: {error}"
+                        )
+                        results["failed"] += 1
+                    else:
+                        logging.warning(
+                            f"Failed to {action} contact {contact_id} group {group_id}, will retry: {error}"
+                        )
+
+        # Anything still pending is waiting on a retry that'll be picked up next time
+        results["retrying"] = self.pending()
+        return results
+
+
+def journal(config: dict[str, Any]) -> GroupJournal:
+    return GroupJournal(
+        tidyhq.client(config),
+        path=config["tidyhq"].get("group_journal", JOURNAL_PATH),
+    )
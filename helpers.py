@@ -0,0 +1,32 @@
+"""Small pieces shared by the scripts: common command line flags and state files."""
+
+import gzip
+import json
+import os
+import sys
+from typing import Any
+
+
+def workers_arg(default: int = 4) -> int:
+    """Read --workers=N from the command line, how many writes can be in flight at once"""
+    for arg in sys.argv:
+        if arg.startswith("--workers="):
+            return max(1, int(arg.split("=", 1)[1]))
+    return default
+
+
+def write_json(path: str, data: Any, compress: bool = False, **kwargs: Any) -> None:
+    """Write data as JSON (gzipped if compress), replacing path in one step
+
+    The file is written alongside first and moved into place so a concurrent reader
+    never sees half of it.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp, "wt") if compress else open(tmp, "w") as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
@@ -0,0 +1,176 @@
+"""Match people across TidyHQ and Slack by email (and name) keys.
+
+Each person is indexed under several normalised keys, strongest first:
+
+* email: the address as given, trimmed and lowercased
+* alias: the address with the provider's own aliasing undone, only for providers
+  where that's actually how delivery works (eg dots and +tags for Gmail)
+* name: their name at their email domain, only for organisation domains where a
+  name is a reasonable identifier
+
+A match is only made when a key points at exactly one person on each side, anything
+else is reported as a collision rather than letting one entry quietly replace another.
+"""
+
+import re
+import unicodedata
+from typing import Any
+
+# Providers that ignore dots in the local part
+DOTLESS_DOMAINS = {"gmail.com", "googlemail.com"}
+
+# Providers that deliver user+anything to user
+PLUS_DOMAINS = {
+    "gmail.com",
+    "googlemail.com",
+    "outlook.com",
+    "hotmail.com",
+    "live.com",
+    "icloud.com",
+    "me.com",
+    "fastmail.com",
+    "protonmail.com",
+    "proton.me",
+}
+
+# Different domains for the same mailboxes
+DOMAIN_ALIASES = {"googlemail.com": "gmail.com"}
+
+# Shared domains where the same name doesn't mean the same person
+PUBLIC_DOMAINS = PLUS_DOMAINS | {
+    "yahoo.com",
+    "yahoo.com.au",
+    "bigpond.com",
+    "bigpond.net.au",
+    "optusnet.com.au",
+    "iinet.net.au",
+    "aol.com",
+    "msn.com",
+}
+
+KINDS = ["email", "alias", "name"]
+
+
+def normalise_email(email: Any) -> str | None:
+    """Trimmed and lowercased address, None for anything that isn't one"""
+    if not isinstance(email, str):
+        return None
+    email = email.strip().lower()
+    user, _, domain = email.rpartition("@")
+    if not user or not domain or " " in email:
+        return None
+    return email
+
+
+def alias_email(email: str) -> str:
+    """The mailbox an already normalised address is delivered to"""
+    user, _, domain = email.rpartition("@")
+    if domain in PLUS_DOMAINS:
+        user = user.split("+", 1)[0]
+    if domain in DOTLESS_DOMAINS:
+        user = user.replace(".", "")
+    return f"{user}@{DOMAIN_ALIASES.get(domain, domain)}"
+
+
+def normalise_name(name: Any) -> str | None:
+    if not isinstance(name, str):
+        return None
+    # Drop accents and punctuation so José O'Brien and Jose OBrien are the same
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    words = re.findall(r"[a-z0-9]+", name.lower().replace("'", ""))
+    return " ".join(words) or None
+
+
+def split_emails(value: Any) -> list[str]:
+    """Addresses from a free text field that may hold several"""
+    if not isinstance(value, str):
+        return []
+    return [part for part in re.split(r"[,;\s]+", value) if part]
+
+
+def identity_keys(emails: list[Any], name: Any = None) -> list[tuple[str, str]]:
+    """Every (kind, key) a person with these addresses and name can be found under"""
+    keys: list[tuple[str, str]] = []
+    normalised_name = normalise_name(name)
+    for email in emails:
+        email = normalise_email(email)
+        if not email:
+            continue
+        keys.append(("email", email))
+        alias = alias_email(email)
+        keys.append(("alias", alias))
+        domain = alias.rpartition("@")[2]
+        # A first name on its own isn't enough to go on
+        if normalised_name and " " in normalised_name and domain not in PUBLIC_DOMAINS:
+            keys.append(("name", f"{normalised_name}@{domain}"))
+    return list(dict.fromkeys(keys))
+
+
+class IdentityIndex:
+    """People keyed by every identity key, each key remembering everyone that has it"""
+
+    def __init__(self) -> None:
+        self.people: dict[str, Any] = {}
+        self.keys: dict[str, dict[str, list[str]]] = {kind: {} for kind in KINDS}
+        self.person_keys: dict[str, list[tuple[str, str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.people)
+
+    def add(self, person_id: str, record: Any, emails: list[Any], name: Any = None):
+        self.people[person_id] = record
+        self.person_keys[person_id] = identity_keys(emails, name)
+        for kind, key in self.person_keys[person_id]:
+            owners = self.keys[kind].setdefault(key, [])
+            if person_id not in owners:
+                owners.append(person_id)
+
+    def lookup(self, kind: str, key: str) -> list[str]:
+        return self.keys[kind].get(key, [])
+
+    def collisions(self) -> dict[tuple[str, str], list[str]]:
+        """Keys shared by more than one person on this side"""
+        return {
+            (kind, key): owners
+            for kind in KINDS
+            for key, owners in self.keys[kind].items()
+            if len(owners) > 1
+        }
+
+
+def match(
+    left: IdentityIndex, right: IdentityIndex
+) -> tuple[dict[str, tuple[str, str]], list[dict[str, Any]]]:
+    """Pair people in left with people in right
+
+    Returns left ID to (right ID, kind of key that matched) and a list of collisions, each
+    with the key and everyone on both sides that shares it. Stronger keys are tried for
+    everyone before weaker ones and a person with an ambiguous key isn't matched on a
+    weaker one.
+    """
+    matches: dict[str, tuple[str, str]] = {}
+    claimed: set[str] = set()
+    conflicted: set[str] = set()
+    conflicts: list[dict[str, Any]] = []
+    reported: set[tuple[str, str]] = set()
+
+    for kind in KINDS:
+        for person_id, keys in left.person_keys.items():
+            if person_id in matches or person_id in conflicted:
+                continue
+            for key_kind, key in keys:
+                if key_kind != kind or not (theirs := right.lookup(kind, key)):
+                    continue
+                ours = left.lookup(kind, key)
+                if len(ours) == 1 and len(theirs) == 1 and theirs[0] not in claimed:
+                    matches[person_id] = (theirs[0], kind)
+                    claimed.add(theirs[0])
+                    break
+                conflicted.add(person_id)
+                if (kind, key) not in reported:
+                    reported.add((kind, key))
+                    conflicts.append(
+                        {"kind": kind, "key": key, "left": ours, "right": theirs}
+                    )
+                break
+    return matches, conflicts
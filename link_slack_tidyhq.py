@@ -1,81 +1,108 @@
 import json
 import logging
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Literal
 
 import requests
 from slack_bolt import App
 
 import errors
-
-
-# Get a list of contacts from TidyHQ that are not linked to a Slack account
-def get_tidyhq() -> dict[Any, Any] | Literal[False]:
+import fuzzy_names
+import helpers
+import identity
+import membership_table
+import notifications
+import rate_limit
+import slack_directory
+import tidyhq
+
+
+# Get an identity index of contacts from TidyHQ that are not linked to a Slack account
+def get_tidyhq() -> tuple[identity.IdentityIndex, set[str]] | Literal[False]:
     logging.debug("Attempting to get contact dump from TidyHQ...")
     try:
-        r = requests.get(
-            "https://api.tidyhq.com/v1/contacts",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
-        contacts: list[dict[str, Any]] = r.json()
+        contacts = tidyhq.index(config)
     except requests.exceptions.RequestException:
         logging.error(errors.tidyhq_connect)
         return False
-    c: dict[str, dict[str, Any]] = {}
+    alternate_fields = config["tidyhq"]["ids"].get("alternate_emails", [])
+    people = identity.IdentityIndex()
     for contact in contacts:
-        in_slack = False
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"] and field["value"]:
-                in_slack = True
-        if not in_slack:
-            c[normalise_email(contact["email_address"])] = contact
-    return c
-
-
-def get_slack():
-    r = app.client.users_list()  # type: ignore
-    c: dict[str, dict[str, str]] = {}
-    while r.data.get("response_metadata", {}).get("next_cursor"):  # type: ignore
-        for user in r.data["members"]:  # type: ignore
-            email: str | Literal[False] = user["profile"].get("email")  # type: ignore
-            if email:
-                c[normalise_email(email)] = {  # type: ignore
-                    "id": user["id"],
-                    "name": user["profile"].get("real_name_normalized"),  # type: ignore
-                }
-        r = app.client.users_list(cursor=r.data["response_metadata"]["next_cursor"])  # type: ignore
-    for user in r.data["members"]:  # type: ignore
-        email: str | Literal[False] = user["profile"].get("email")  # type: ignore
+        if contacts.field(contact["id"], config["tidyhq"]["ids"]["slack"]):
+            continue
+        emails = [contact.get("email_address")]
+        for field in alternate_fields:
+            emails.extend(identity.split_emails(contacts.field(contact["id"], field)))
+        people.add(
+            str(contact["id"]),
+            contact,
+            emails,
+            name=f"{contact.get('first_name') or ''} {contact.get('last_name') or ''}",
+        )
+    # Slack users that are already linked to someone can't be matched again
+    return people, set(contacts.by_slack)
+
+
+def get_slack(linked: set[str]) -> identity.IdentityIndex:
+    directory = slack_directory.load(app.client, config)
+    people = identity.IdentityIndex()
+    for user in directory.humans():
+        if user["deleted"] or user["id"] in linked:
+            continue
+        email: str | None = user["profile"].get("email")
         if email:
-            c[normalise_email(email)] = {  # type: ignore
-                "id": user["id"],
-                "name": user["profile"].get("real_name_normalized"),  # type: ignore
-            }
-    return c
+            people.add(
+                user["id"],
+                {
+                    "id": user["id"],
+                    "name": user["profile"].get("real_name_normalized"),
+                    "display_name": user["profile"].get("display_name_normalized"),
+                },
+                [email],
+                name=user["profile"].get("real_name_normalized"),
+            )
+    return people
 
 
-def get_tidyhq_memberships() -> list[dict[str, Any]] | Literal[False]:
+# Get the IDs of contacts with a membership running today
+def get_tidyhq_memberships() -> set[str] | Literal[False]:
     try:
-        r = requests.get(
-            "https://api.tidyhq.com/v1//memberships",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
+        memberships = tidyhq.client(config).memberships()
     except requests.exceptions.RequestException:
         logging.error(errors.tidyhq_connect)
         return False
-    memberships = r.json()
-    active: list[dict[str, Any]] = []
-    for membership in memberships:
-        if membership["state"] != "expired":
-            active.append(membership["contact_id"])
-    return active
+    table = membership_table.MembershipTable(memberships)
+    return membership_table.IntervalIndex(table).active_contacts()
+
+
+def suggest_slack_users(
+    tidyhq_ids: list[str],
+) -> dict[str, list[tuple[str, float]]]:
+    """Slack users with the most similar names for each TidyHQ contact, scored in one batch"""
+    taken = {slack_id for slack_id, _ in matches.values()}
+    names = fuzzy_names.NameIndex(
+        {
+            slack_id: [s["name"], s["display_name"]]
+            for slack_id, s in slack_users.people.items()
+            if slack_id not in taken
+        }
+    )
+    queries = {}
+    for tidyhq_id in tidyhq_ids:
+        t = tidyhq_users.people[tidyhq_id]
+        queries[tidyhq_id] = f"{t.get('first_name') or ''} {t.get('last_name') or ''}"
+    logging.debug(f"Scoring {len(queries)} names against {len(names)} Slack users")
+    return names.suggest(queries, k=SUGGESTIONS)
 
 
 def link_accounts(tidyhq_id: str, slack_id: str) -> bool:
     try:
-        r = requests.put(
-            f"https://api.tidyhq.com/v1/contacts/{tidyhq_id}",
-            params={"access_token": config["tidyhq"]["token"]},
+        r = rate_limit.scheduler().tidyhq(
+            tidyhq.client(config).put,
+            f"contacts/{tidyhq_id}",
             json={"custom_fields": {config["tidyhq"]["ids"]["slack"]: slack_id}},
         )
         if r.status_code != 200:
@@ -90,13 +117,71 @@ def link_accounts(tidyhq_id: str, slack_id: str) -> bool:
         return False
 
 
+def link(slack_user: dict[str, Any], tidyhq_user: dict[str, Any], method: str):
+    """Link now, or queue the link for apply_links() in batch mode"""
+    if batch is None:
+        if link_accounts(tidyhq_user["id"], slack_user["id"]):
+            notify_slack(slack_user, tidyhq_user, method)
+        return
+    batch[str(tidyhq_user["id"])] = {
+        "slack": {"id": slack_user["id"]},
+        "tidyhq": {
+            "id": tidyhq_user["id"],
+            "first_name": tidyhq_user["first_name"],
+            "last_name": tidyhq_user["last_name"],
+        },
+        "method": method,
+    }
+
+
+def apply_links(links: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """PUT every queued link at once within the TidyHQ rate limit, returning the ones that failed"""
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(link_accounts, l["tidyhq"]["id"], l["slack"]["id"]): l
+            for l in links
+        }
+        for future in as_completed(futures):
+            l = futures[future]
+            if future.result():
+                notify_slack(l["slack"], l["tidyhq"], l["method"])
+            else:
+                failed.append(l)
+    return failed
+
+
+def load_pending() -> dict[str, dict[str, Any]]:
+    """Links that failed last time and still apply, keyed by TidyHQ ID"""
+    if not os.path.exists(PENDING_PATH):
+        return {}
+    with open(PENDING_PATH, "r") as f:
+        pending = json.load(f)
+    return {
+        tidyhq_id: l
+        for tidyhq_id, l in pending.items()
+        if tidyhq_id in tidyhq_users.people and l["slack"]["id"] not in linked_slack_ids
+    }
+
+
+def save_pending(links: list[dict[str, Any]]) -> None:
+    if not links:
+        if os.path.exists(PENDING_PATH):
+            os.remove(PENDING_PATH)
+        return
+    helpers.write_json(
+        PENDING_PATH, {str(l["tidyhq"]["id"]): l for l in links}, indent=4
+    )
+
+
 def notify_slack(slack_user: dict[str, Any], tidyhq_user: dict[str, Any], method: str):
+    message = f'TidyHQ account <https://{domain}.tidyhq.com/contacts/{tidyhq_user["id"]}|{tidyhq_user["first_name"]} {tidyhq_user["last_name"]}> has been linked to <@{slack_user["id"]}>'
     blocks = [
         {
             "type": "section",
             "text": {
                 "type": "mrkdwn",
-                "text": f'TidyHQ account <https://{domain}.tidyhq.com/contacts/{tidyhq_user["id"]}|{tidyhq_user["first_name"]} {tidyhq_user["last_name"]}> has been linked to <@{slack_user["id"]}>',
+                "text": message,
             },
         },
         {
@@ -111,37 +196,8 @@ def notify_slack(slack_user: dict[str, Any], tidyhq_user: dict[str, Any], method
         },
     ]
 
-    # Send notification to Slack
-    app.client.chat_postMessage(  # type: ignore
-        channel=config["slack"]["notification_channel"],
-        text="Linked a TidyHQ account to a Slack account",
-        blocks=blocks,
-    )
-
-
-def normalise_email(email: str) -> str:
-    # Sometimes this function will be passed things that aren't strings
-    if type(email) is not str:
-        print(f"Got {email} of type {type(email)}")
-        return email
-
-    # split into user and domain
-    user, domain = email.split("@")
-
-    # Remove dots from user
-    user = user.replace(".", "")
-
-    # Remove everything after a plus but keep the domain
-    if "+" in user:
-        user = user.split("+")[0]
-
-    # Rejoin user and domain
-    email = f"{user}@{domain}"
-
-    # Lowercase
-    email = email.lower()
-
-    return email
+    # Send notification to Slack, or hold it for the digest
+    notifier.notify(f"{message} ({method})", blocks=blocks)
 
 
 # load config from config.json
@@ -163,37 +219,94 @@ logging.info(
     f'Connected to Slack as "{slack_info["user"]} with ID {slack_info["user_id"]}'
 )
 
-logging.info("Getting Slack users...")
-slack_users = get_slack()
-logging.debug(f"Got {len(slack_users)} Slack users")
-
 logging.info("Getting TidyHQ users...")
-tidyhq_users = get_tidyhq()
-if not tidyhq_users:
+tidyhq_data = get_tidyhq()
+if not tidyhq_data:
     exit(1)
-logging.debug(f"Got {len(tidyhq_users)} TidyHQ users")
+tidyhq_users, linked_slack_ids = tidyhq_data
+logging.debug(f"Got {len(tidyhq_users)} unlinked TidyHQ users")
+
+logging.info("Getting Slack users...")
+slack_users = get_slack(linked_slack_ids)
+logging.debug(f"Got {len(slack_users)} unlinked Slack users")
+
+matches, conflicts = identity.match(tidyhq_users, slack_users)
+logging.info(f"Matched {len(matches)} accounts, {len(conflicts)} ambiguous")
+for conflict in conflicts:
+    logging.warning(
+        f"Not linking on {conflict['kind']} {conflict['key']}, shared by TidyHQ contacts "
+        f"{', '.join(conflict['left'])} and Slack users {', '.join(conflict['right'])}"
+    )
+
+# How each kind of key is described in notifications
+MATCH_METHODS = {
+    "email": "automated email address matching",
+    "alias": "automated email address matching",
+    "name": "automated name and email domain matching",
+    "fuzzy": "automated name similarity matching",
+}
+
+# Links that failed during a --batch run, picked up by the next one
+PENDING_PATH = "link_slack_tidyhq_pending.json"
+LINK_RETRIES = 2
+LINK_RETRY_DELAY = 5
+
+# How many similar Slack users to suggest for each unmatched contact
+SUGGESTIONS = 3
+
+# Check for --fuzzy-threshold=<0-1>, name similarity above which we link without asking
+fuzzy_threshold = None
+for arg in sys.argv:
+    if arg.startswith("--fuzzy-threshold="):
+        fuzzy_threshold = float(arg.split("=", 1)[1])
+
+# Check for --batch, collect every link first and then apply them all at once
+batch: dict[str, dict[str, Any]] | None = None
+if "--batch" in sys.argv:
+    batch = load_pending()
+    if batch:
+        logging.info(f"Retrying {len(batch)} links that failed last time")
+
+# Check for --workers=N, how many TidyHQ updates can be in flight at once in batch mode
+workers = helpers.workers_arg()
 
 # Get TidyHQ org name for URLs.
-domain: str = requests.get(
-    "https://api.tidyhq.com/v1/organization",
-    params={"access_token": config["tidyhq"]["token"]},
-).json()["domain_prefix"]
+domain: str = tidyhq.client(config).domain()
+
+notifier = notifications.Notifier(
+    app.client,
+    channel=config["slack"]["notification_channel"],
+    title="Linked TidyHQ accounts to Slack",
+    mode=notifications.mode_arg(
+        default="digest" if batch is not None else "per-change"
+    ),
+)
 
 # Check for --cron flag
 if len(sys.argv) > 1 and "--cron" in sys.argv:
     logging.info("Running in cron mode")
 
-    # Check for any users in Slack that are not in TidyHQ
-    for email in tidyhq_users:
-        t = tidyhq_users[email]
-        if email in slack_users:
-            s = slack_users[email]
-            # Link the user
+    # Link every TidyHQ contact that has an unambiguous match in Slack
+    for tidyhq_id, (slack_id, kind) in matches.items():
+        t = tidyhq_users.people[tidyhq_id]
+        s = slack_users.people[slack_id]
+        logging.info(
+            f"Match ({kind}):\nTidyHQ: {t['first_name']} {t['last_name']} ({t['id']})\nSlack: {s['name']} ({s['id']})"
+        )
+        link(s, t, MATCH_METHODS[kind])
+
+    if fuzzy_threshold is not None:
+        unmatched = [i for i in tidyhq_users.people if i not in matches]
+        suggestions = suggest_slack_users(unmatched)
+        for tidyhq_id, (slack_id, score) in fuzzy_names.confident(
+            suggestions, fuzzy_threshold
+        ).items():
+            t = tidyhq_users.people[tidyhq_id]
+            s = slack_users.people[slack_id]
             logging.info(
-                f"Match:\nTidyHQ: {t['first_name']} {t['last_name']} ({t['id']})\nSlack: {s['name']} ({s['id']})"
+                f"Match (fuzzy {score:.0%}):\nTidyHQ: {t['first_name']} {t['last_name']} ({t['id']})\nSlack: {s['name']} ({s['id']})"
             )
-            if link_accounts(t["id"], s["id"]):
-                notify_slack(s, t, "automated email address matching")
+            link(s, t, MATCH_METHODS["fuzzy"])
 
 else:
     logging.info("Running in interactive mode")
@@ -206,30 +319,80 @@ else:
         exit(1)
     logging.debug(f"Got {len(tidyhq_active_users)} TidyHQ active users")
 
-    # Compare the two lists and link any users that are in both
-    for email in tidyhq_users:
-        t = tidyhq_users[email]
-        if email in slack_users:
+    # Score every unmatched active member against Slack up front rather than per prompt
+    unmatched = [
+        tidyhq_id
+        for tidyhq_id, t in tidyhq_users.people.items()
+        if tidyhq_id not in matches and str(t["id"]) in tidyhq_active_users
+    ]
+    suggestions = suggest_slack_users(unmatched)
+    confident = {}
+    if fuzzy_threshold is not None:
+        confident = fuzzy_names.confident(suggestions, fuzzy_threshold)
+
+    # Confirm each match and ask about active members we couldn't match
+    for tidyhq_id, t in tidyhq_users.people.items():
+        if tidyhq_id in matches:
             print("\n")
-            s = slack_users[email]
+            slack_id, kind = matches[tidyhq_id]
+            s = slack_users.people[slack_id]
             # Link the user
             print(
-                f"Match:\nTidyHQ: {t['first_name']} {t['last_name']} ({t['id']})\nSlack: {s['name']} ({s['id']})"
+                f"Match ({kind}):\nTidyHQ: {t['first_name']} {t['last_name']} ({t['id']})\nSlack: {s['name']} ({s['id']})"
             )
             i = input("Yes? [Y/n]")
             if i != "n":
-                link_accounts(t["id"], s["id"])
-                notify_slack(s, t, "automated email address matching")
+                link(s, t, MATCH_METHODS[kind])
             else:
                 print("Skipping")
+        elif tidyhq_id in confident:
+            slack_id, score = confident[tidyhq_id]
+            s = slack_users.people[slack_id]
+            logging.info(
+                f"Linking {t['first_name']} {t['last_name']} to {s['name']} ({s['id']}), names are {score:.0%} similar"
+            )
+            link(s, t, MATCH_METHODS["fuzzy"])
         else:
-            if tidyhq_users[email]["id"] in tidyhq_active_users:
+            if str(t["id"]) in tidyhq_active_users:
                 print(
-                    f"Could not find {tidyhq_users[email]['first_name']} {tidyhq_users[email]['last_name']} in Slack but they are an active member"
+                    f"Could not find {t['first_name']} {t['last_name']} in Slack but they are an active member"
                 )
-                slack_id: str = input("Enter Slack ID [or leave blank to skip]: ")
+                candidates = suggestions.get(tidyhq_id, [])
+                for number, (candidate, score) in enumerate(candidates, start=1):
+                    s = slack_users.people[candidate]
+                    print(f"  {number}) {s['name']} ({s['id']}) {score:.0%}")
+                slack_id = input(
+                    "Enter Slack ID or suggestion number [or leave blank to skip]: "
+                )
+                if slack_id.isdigit() and 0 < int(slack_id) <= len(candidates):
+                    slack_id = candidates[int(slack_id) - 1][0]
                 if slack_id:
-                    if link_accounts(t["id"], slack_id):
-                        notify_slack({"id": slack_id}, t, "manual entry")
+                    link({"id": slack_id}, t, "manual entry")
                 else:
                     print("Skipping")
+
+if batch is not None:
+    # One contact per Slack user, links made this run win over old pending ones
+    links = list({l["slack"]["id"]: l for l in batch.values()}.values())
+    logging.info(f"Linking {len(links)} accounts")
+    failed = apply_links(links)
+    # Only retry the links that failed, not the matching
+    for attempt in range(LINK_RETRIES):
+        if not failed:
+            break
+        logging.warning(f"Retrying {len(failed)} failed links")
+        time.sleep(LINK_RETRY_DELAY * (attempt + 1))
+        failed = apply_links(failed)
+
+    for l in failed:
+        notifier.notify(
+            f"Could not link TidyHQ contact {l['tidyhq']['first_name']} {l['tidyhq']['last_name']} ({l['tidyhq']['id']}) to <@{l['slack']['id']}>"
+        )
+    logging.info(f"Linked {len(links) - len(failed)} accounts, {len(failed)} failed")
+    # Whatever is left gets another go next time --batch runs
+    save_pending(failed)
+
+notifier.flush()
+
+# We've (probably) changed contacts so make sure the next script picks them up
+tidyhq.expire_snapshot(config)
@@ -0,0 +1,262 @@
+"""TidyHQ memberships as NumPy columns.
+
+Dates from TidyHQ turn up as plain dates, day-first dates and timestamps with an
+offset depending on the endpoint and how old the membership is. They're parsed once
+here into datetime64 columns (wall time, like the dates people see in TidyHQ)
+so questions like "who was active on X" or "whose membership ends in the next N
+days" are array expressions rather than a strptime per row.
+"""
+
+import random
+import re
+import sys
+import time
+from datetime import date, datetime, timedelta
+from typing import Any
+
+import numpy as np
+
+# Stand in for a membership that never ends, far enough out that nothing else compares
+NEVER = np.datetime64("9999-12-31T00:00:00", "s")
+
+# 2023-12-31, 31-12-2023 or either with a time, fractions and an offset after it
+DATE_FORMAT = re.compile(
+    r"^(?:(\d{4})-(\d{2})-(\d{2})|(\d{2})-(\d{2})-(\d{4}))"
+    r"(?:[T ](\d{2}:\d{2}(?::\d{2})?)(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?$"
+)
+
+
+def _iso(value: Any) -> str:
+    """Rewrite a date as something datetime64 can read, "NaT" if it isn't one
+
+    Offsets are dropped rather than converted. TidyHQ gives times in the organisation's
+    timezone so the wall time is the date people see, which is what we compare against.
+    """
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    if not isinstance(value, str) or not (match := DATE_FORMAT.match(value.strip())):
+        return "NaT"
+    year, month, day, day_first, month_first, year_last, clock = match.groups()
+    if year is None:
+        year, month, day = year_last, month_first, day_first
+    return f"{year}-{month}-{day}T{clock}" if clock else f"{year}-{month}-{day}"
+
+
+def parse_date(value: Any) -> np.datetime64:
+    """One TidyHQ date, NaT if it's missing or can't be read"""
+    try:
+        return np.datetime64(_iso(value), "s")
+    except ValueError:
+        return np.datetime64("NaT", "s")
+
+
+def parse_dates(values: list[Any]) -> np.ndarray:
+    """Parse a column of dates, each distinct value is only rewritten once"""
+    # Most memberships share their start/end dates with lots of others
+    codes: dict[Any, int] = {}
+    column = [
+        codes.setdefault(v if isinstance(v, (str, type(None))) else repr(v), len(codes))
+        for v in values
+    ]
+    originals: dict[int, Any] = {}
+    for value, code in zip(values, column):
+        originals.setdefault(code, value)
+    unique = [_iso(originals[code]) for code in range(len(codes))]
+    try:
+        parsed = np.array(unique, dtype="datetime64[s]")
+    except ValueError:
+        # Something shaped like a date that isn't one (31-02-2023), go one at a time
+        parsed = np.array(
+            [parse_date(value) for value in unique], dtype="datetime64[s]"
+        )
+    return parsed[np.array(column, dtype=np.intp)]
+
+
+def as_datetime64(when: Any = None) -> np.datetime64:
+    if isinstance(when, np.datetime64):
+        return when.astype("datetime64[s]")
+    if when is None:
+        when = datetime.now().replace(microsecond=0)
+    parsed = parse_date(when)
+    if np.isnat(parsed):
+        raise ValueError(f"Could not read date {when!r}")
+    return parsed
+
+
+class MembershipTable:
+    """Memberships as columns, contacts and levels are stored as codes into contacts/levels"""
+
+    def __init__(self, memberships: list[dict[str, Any]]) -> None:
+        self.memberships = memberships
+        self.start = parse_dates([m.get("start_date") for m in memberships])
+        end = parse_dates([m.get("end_date") for m in memberships])
+        self.open_ended = np.isnat(end)
+        self.end = np.where(self.open_ended, NEVER, end)
+
+        contact_codes: dict[str, int] = {}
+        self.contact = np.array(
+            [
+                contact_codes.setdefault(str(m.get("contact_id")), len(contact_codes))
+                for m in memberships
+            ],
+            dtype=np.intp,
+        )
+        self.contacts = list(contact_codes)
+
+        level_codes: dict[str, int] = {}
+        self.level_names: dict[str, str] = {}
+        level_column = []
+        for m in memberships:
+            level_id = m.get("membership_level_id")
+            if level_id is None:
+                level_id = (m.get("membership_level") or {}).get("id")
+            code = level_codes.setdefault(str(level_id), len(level_codes))
+            if code == len(self.level_names):
+                name = (m.get("membership_level") or {}).get("name")
+                self.level_names[str(level_id)] = name or str(level_id)
+            level_column.append(code)
+        self.level = np.array(level_column, dtype=np.intp)
+        self.levels = list(level_codes)
+
+    def __len__(self) -> int:
+        return len(self.memberships)
+
+    def active_on(self, when: Any = None) -> np.ndarray:
+        """Mask of memberships running at a point in time (default now)"""
+        t = as_datetime64(when)
+        return (self.start <= t) & (t <= self.end)
+
+
+class IntervalIndex:
+    """Sorted membership endpoints for answering "when" questions in logarithmic time
+
+    Contacts are sorted by when their last membership ends for expiring/lapsed lookups,
+    and each level keeps sorted starts and ends for headcounts at any time.
+    """
+
+    def __init__(self, table: MembershipTable, end_unit: str = "s") -> None:
+        """end_unit rounds ends down for ending_between(), eg "D" to compare whole dates"""
+        self.table = table
+        self.contacts = table.contacts
+
+        # Contacts by when their last membership ends, open ended ones count as NEVER
+        last = np.full(
+            len(self.contacts), np.datetime64("0001-01-01", "s"), dtype="datetime64[s]"
+        )
+        ends = table.end.astype(f"datetime64[{end_unit}]").astype("datetime64[s]")
+        np.maximum.at(last, table.contact, ends)
+        self.by_last_end = np.argsort(last, kind="stable")
+        self.last_ends = last[self.by_last_end]
+
+        # Per level sorted starts and ends
+        self.level_starts: dict[str, np.ndarray] = {}
+        self.level_ends: dict[str, np.ndarray] = {}
+        order = np.argsort(table.level, kind="stable")
+        bounds = np.searchsorted(table.level[order], np.arange(len(table.levels) + 1))
+        for code, level in enumerate(table.levels):
+            rows = order[bounds[code] : bounds[code + 1]]
+            self.level_starts[level] = np.sort(table.start[rows])
+            self.level_ends[level] = np.sort(table.end[rows])
+
+    def active_contacts(self, when: Any = None) -> set[str]:
+        """Every contact with a membership running at when (default now)"""
+        mask = self.table.active_on(when)
+        return {self.contacts[code] for code in np.unique(self.table.contact[mask])}
+
+    def ending_between(self, start: Any, end: Any) -> dict[str, np.datetime64]:
+        """Contacts whose last membership ends in [start, end), with when it ends"""
+        first = np.searchsorted(self.last_ends, as_datetime64(start), side="left")
+        last = np.searchsorted(self.last_ends, as_datetime64(end), side="left")
+        return {
+            self.contacts[code]: self.last_ends[i]
+            for i, code in enumerate(self.by_last_end[first:last], start=first)
+        }
+
+    def level_counts(self, times: Any) -> dict[str, np.ndarray]:
+        """How many memberships were active at each of times, per level name"""
+        times = np.asarray(times, dtype="datetime64[s]")
+        counts: dict[str, np.ndarray] = {}
+        for level in self.table.levels:
+            # Started on or before t, less those that ended before t
+            active = np.searchsorted(
+                self.level_starts[level], times, side="right"
+            ) - np.searchsorted(self.level_ends[level], times, side="left")
+            name = self.table.level_names[level]
+            counts[name] = counts[name] + active if name in counts else active
+        return counts
+
+    def count_active(self, when: Any = None) -> dict[str, int]:
+        """Active memberships per level name at when (default now)"""
+        counts = self.level_counts(np.array([as_datetime64(when)]))
+        return {name: int(count[0]) for name, count in counts.items() if count[0]}
+
+
+def date_range(start: Any, end: Any, step: str = "month") -> np.ndarray:
+    """Every step (day, week, month, year or a number of days) from start up to end"""
+    first = as_datetime64(start).astype("datetime64[D]")
+    last = as_datetime64(end).astype("datetime64[D]")
+    if step in ("month", "year"):
+        # Years are 12 month steps so the month and day both stay put
+        stride = 1 if step == "month" else 12
+        # Keep the day of the month (clamped to the end of shorter months)
+        offset = first - first.astype("datetime64[M]").astype("datetime64[D]")
+        months = np.arange(
+            first.astype("datetime64[M]"),
+            last.astype("datetime64[M]") + 1,
+            stride,
+        )
+        next_months = (months + 1).astype("datetime64[D]")
+        days = np.minimum(months.astype("datetime64[D]") + offset, next_months - 1)
+        days = days[(days >= first) & (days <= last)]
+    else:
+        days_per_step = {"day": 1, "week": 7}.get(step)
+        if days_per_step is None:
+            days_per_step = int(step)
+        days = np.arange(first, last + 1, np.timedelta64(days_per_step, "D"))
+    return days.astype("datetime64[s]")
+
+
+def benchmark(rows: int = 100000) -> None:
+    """Time building a table from synthetic memberships in every date format"""
+    random.seed(1)
+    formats = [
+        lambda d: d.strftime("%Y-%m-%d"),
+        lambda d: d.strftime("%d-%m-%Y"),
+        lambda d: d.strftime("%Y-%m-%dT%H:%M:%S+08:00"),
+        lambda d: d.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    ]
+    first = datetime(2015, 1, 1)
+    memberships = []
+    for i in range(rows):
+        start = first + timedelta(days=random.randrange(3650))
+        end = start + timedelta(days=random.choice([30, 91, 182, 365]))
+        memberships.append(
+            {
+                "contact_id": random.randrange(rows // 3),
+                "membership_level_id": random.randrange(12),
+                "membership_level": {"name": f"Level {i % 12}"},
+                "start_date": random.choice(formats)(start),
+                "end_date": random.choice(formats)(end) if i % 50 else None,
+            }
+        )
+
+    started = time.perf_counter()
+    table = MembershipTable(memberships)
+    built = time.perf_counter()
+    index = IntervalIndex(table)
+    indexed = time.perf_counter()
+    active = index.active_contacts("2020-06-01")
+    expiring = index.ending_between("2020-06-01", "2020-07-01")
+    series = index.level_counts(date_range("2015-01-01", "2024-12-31", "day"))
+    finished = time.perf_counter()
+    print(
+        f"{rows} memberships: parsed in {built - started:.3f}s, indexed in "
+        f"{indexed - built:.3f}s, queries in {finished - indexed:.3f}s "
+        f"({len(active)} active, {len(expiring)} expiring, "
+        f"{len(next(iter(series.values())))} day series)"
+    )
+
+
+if __name__ == "__main__":
+    # python membership_table.py [rows]
+    benchmark(*(int(arg) for arg in sys.argv[1:2]))
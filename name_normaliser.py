@@ -0,0 +1,223 @@
+"""Fix the capitalisation of names typed into TidyHQ.
+
+The rules are declared in RULES and compiled once into regexes and sets. Every word
+gets its first letter capitalised, as does every part after an apostrophe or hyphen,
+and the rest of the word is left alone so "DeVries" stays as typed. Prefixes like
+Mc/Mac capitalise the letter after them, unless the word is a listed exception, and
+lower case particles like "van der" are left lower case unless they're the last word.
+
+Words are memoised since the same few thousand first and last names make up most of
+any contact list, so normalise_names() over a whole dump is mostly dictionary hits.
+"""
+
+import random
+import re
+import sys
+import time
+from functools import lru_cache
+from typing import Any
+
+RULES: dict[str, Any] = {
+    # Prefix and how many letters must follow it before the next one is capitalised,
+    # so "Mack" and "Macey" aren't touched but "Macdonald" becomes "MacDonald"
+    "prefixes": {"Mc": 1, "Mac": 4},
+    # Words that look like they start with a prefix but don't. Each has to be long
+    # enough for its prefix to apply, compile_rules() rejects any that aren't.
+    "exceptions": [
+        "macaulay",
+        "machado",
+        "macklin",
+        "macquarie",
+    ],
+    # Only left alone when typed in lower case, "De Souza" is as valid as "de Souza"
+    "particles": [
+        "da",
+        "das",
+        "de",
+        "del",
+        "della",
+        "den",
+        "der",
+        "di",
+        "do",
+        "dos",
+        "du",
+        "la",
+        "le",
+        "te",
+        "ten",
+        "ter",
+        "van",
+        "von",
+    ],
+    # Every one of these starts a new part of the word
+    "separators": "'‘’ʼ-‐‑–",
+}
+
+# How many distinct words to remember
+CACHE_SIZE = 1 << 16
+
+
+def compile_rules(
+    rules: dict[str, Any],
+) -> tuple[re.Pattern, re.Pattern, frozenset, frozenset]:
+    """Turn a rules table into (separator, prefix) regexes and (exception, particle) sets"""
+    separators = re.compile(f"([{re.escape(rules['separators'])}])")
+    # Longest first so a prefix wins over any shorter one it starts with
+    prefixes = sorted(rules["prefixes"].items(), key=lambda p: -len(p[0]))
+    prefix = re.compile(
+        "|".join(f"(?:{re.escape(p)}(?=[^\\W\\d_]{{{n}}}))" for p, n in prefixes)
+    )
+    for word in rules["exceptions"]:
+        if not prefix.match(word[:1].upper() + word[1:]):
+            raise ValueError(f"Exception {word} would never match a prefix rule")
+    return (
+        separators,
+        prefix,
+        frozenset(word.lower() for word in rules["exceptions"]),
+        frozenset(word.lower() for word in rules["particles"]),
+    )
+
+
+SEPARATORS, PREFIX, EXCEPTIONS, PARTICLES = compile_rules(RULES)
+
+
+def _capitalise(part: str) -> str:
+    """Capitalise the first letter of one part of a word and the letter after any prefix"""
+    if not part:
+        return part
+    part = part[0].upper() + part[1:]
+    if part.lower() in EXCEPTIONS:
+        return part
+    match = PREFIX.match(part)
+    if match:
+        end = match.end()
+        part = part[:end] + part[end].upper() + part[end + 1 :]
+    return part
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalise_word(word: str) -> str:
+    """Capitalise a single word, including after every apostrophe and hyphen"""
+    # re.split with a group keeps the separators at the odd indexes
+    return "".join(_capitalise(part) for part in SEPARATORS.split(word))
+
+
+def normalise_name(name: Any) -> Any:
+    """Fix one name, trimming and collapsing whitespace. Anything falsy comes back untouched."""
+    if not name:
+        return name
+    words = name.split()
+    last = len(words) - 1
+    return " ".join(
+        word if i < last and word in PARTICLES else normalise_word(word)
+        for i, word in enumerate(words)
+    )
+
+
+def normalise_names(names: list[Any]) -> list[Any]:
+    """Fix a batch of names, working out each distinct name once"""
+    done: dict[Any, Any] = {}
+    out = []
+    for name in names:
+        try:
+            out.append(done[name])
+        except KeyError:
+            done[name] = fixed = normalise_name(name)
+            out.append(fixed)
+    return out
+
+
+# (typed, expected) pairs that every change to RULES has to keep passing
+CORPUS = [
+    ("", ""),
+    (None, None),
+    ("john", "John"),
+    ("  john   smith ", "John Smith"),
+    ("JOHN", "JOHN"),
+    ("deVries", "DeVries"),
+    ("mcdonald", "McDonald"),
+    ("McDonald", "McDonald"),
+    ("mc", "Mc"),
+    ("macdonald", "MacDonald"),
+    ("mack", "Mack"),
+    ("macey", "Macey"),
+    ("machado", "Machado"),
+    ("macias", "Macias"),
+    ("o'brien", "O'Brien"),
+    ("o’neill", "O’Neill"),
+    ("d'arcy-o'connor", "D'Arcy-O'Connor"),
+    ("o'", "O'"),
+    ("jones'", "Jones'"),
+    ("smith-jones", "Smith-Jones"),
+    ("smith-jones-brown", "Smith-Jones-Brown"),
+    ("smith-mcdonald", "Smith-McDonald"),
+    ("mary-jane", "Mary-Jane"),
+    ("-smith", "-Smith"),
+    ("van der berg", "van der Berg"),
+    ("Van Der Berg", "Van Der Berg"),
+    ("ludwig van", "Ludwig Van"),
+    ("de", "De"),
+    ("maria da silva", "Maria da Silva"),
+    ("jean-luc de la tour", "Jean-Luc de la Tour"),
+    ("élodie", "Élodie"),
+    ("ng", "Ng"),
+    ("x æ a-12", "X Æ A-12"),
+]
+
+
+def check() -> list[tuple[Any, Any, Any]]:
+    """Run the corpus, returning (typed, expected, got) for every mismatch"""
+    got = normalise_names([typed for typed, _ in CORPUS])
+    return [
+        (typed, expected, fixed)
+        for (typed, expected), fixed in zip(CORPUS, got)
+        if fixed != expected
+    ]
+
+
+def benchmark(count: int = 1000000) -> None:
+    """Time normalise_names() over a contact list's worth of badly typed names"""
+    random.seed(1)
+    given = ["james", "mary", "wei", "aroha", "siobhan", "jean-luc", "mary-jane"]
+    given += ["mohammed", "priya", "olga", "kofi", "zoë", "liam", "ngaio", "ana"]
+    family = ["smith", "o'brien", "mcdonald", "macdonald", "van der berg", "ng"]
+    family += ["d'arcy-o'connor", "da silva", "nguyen", "macklin", "smith-jones"]
+    family += ["o’neill", "de la tour", "mackay", "kowalski", "te whata", "patel"]
+
+    def typed(name: str) -> str:
+        # How names actually arrive: shouting, stray spaces and half-capitalised
+        style = random.random()
+        if style < 0.1:
+            name = name.upper()
+        elif style < 0.4:
+            name = name.title()
+        if random.random() < 0.1:
+            name = f" {name}  "
+        return name
+
+    # Repeated often enough to look like a real list, varied enough to miss the cache
+    names = [
+        typed(random.choice(given) if i % 2 else random.choice(family))
+        + (str(random.randrange(50)) if random.random() < 0.05 else "")
+        for i in range(count)
+    ]
+
+    normalise_word.cache_clear()
+    started = time.perf_counter()
+    normalise_names(names)
+    finished = time.perf_counter()
+    print(
+        f"{count} names ({len(set(names))} distinct): {finished - started:.2f}s, "
+        f"{count / (finished - started):,.0f} names/s"
+    )
+
+
+if __name__ == "__main__":
+    # python name_normaliser.py [names]
+    failures = check()
+    for typed, expected, got in failures:
+        print(f"{typed!r}: expected {expected!r}, got {got!r}")
+    print(f"Corpus: {len(CORPUS) - len(failures)}/{len(CORPUS)} passed")
+    benchmark(*(int(arg) for arg in sys.argv[1:2]))
+    sys.exit(1 if failures else 0)
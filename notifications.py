@@ -0,0 +1,122 @@
+"""Notification channel posting with optional digests.
+
+Scripts that make lots of changes report each one through a Notifier. Depending
+on --notify it either posts every change as it happens (the old behaviour),
+collects them into a Block Kit digest posted at the end of the run, or stays quiet.
+"""
+
+import logging
+import sys
+import threading
+from typing import Any
+
+import rate_limit
+
+MODES = ["per-change", "digest", "none"]
+
+# Slack limits https://api.slack.com/reference/block-kit/blocks
+MAX_BLOCKS = 50
+MAX_SECTION_TEXT = 3000
+
+
+def mode_arg(default: str = "per-change") -> str:
+    """Read --notify=<mode> from the command line"""
+    for arg in sys.argv:
+        if arg.startswith("--notify="):
+            mode = arg.split("=", 1)[1]
+            if mode not in MODES:
+                sys.exit(f"Invalid notify mode: {mode} (expected one of {MODES})")
+            return mode
+    return default
+
+
+def digest_messages(title: str, lines: list[str]) -> list[list[dict[str, Any]]]:
+    """Pack lines into as few messages as possible, each within Slack's block limits"""
+    sections: list[str] = []
+    current = ""
+    for line in lines:
+        line = line[:MAX_SECTION_TEXT]
+        if current and len(current) + len(line) + 1 > MAX_SECTION_TEXT:
+            sections.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        sections.append(current)
+
+    messages = []
+    # Leave room for the header on each message
+    per_message = MAX_BLOCKS - 1
+    for i in range(0, len(sections), per_message):
+        part = f" ({i // per_message + 1})" if len(sections) > per_message else ""
+        blocks: list[dict[str, Any]] = [
+            {
+                "type": "header",
+                "text": {
+                    "type": "plain_text",
+                    "text": f"{title}: {len(lines)} changes{part}",
+                },
+            }
+        ]
+        for section in sections[i : i + per_message]:
+            blocks.append(
+                {"type": "section", "text": {"type": "mrkdwn", "text": section}}
+            )
+        messages.append(blocks)
+    return messages
+
+
+class Notifier:
+    def __init__(
+        self,
+        client,
+        channel: str,
+        title: str,
+        mode: str = "per-change",
+        username: str | None = None,
+        icon_emoji: str | None = None,
+    ) -> None:
+        self.client = client
+        self.channel = channel
+        self.title = title
+        self.mode = mode
+        self.identity = {}
+        if username:
+            self.identity["username"] = username
+        if icon_emoji:
+            self.identity["icon_emoji"] = icon_emoji
+        self.lines: list[str] = []
+        self.lock = threading.Lock()
+        self.limiter = rate_limit.scheduler()
+
+    def _post(self, **kwargs: Any) -> None:
+        self.limiter.slack(
+            self.client,
+            "chat_postMessage",
+            channel=self.channel,
+            **self.identity,
+            **kwargs,
+        )
+
+    def notify(self, text: str, blocks: list[dict[str, Any]] | None = None) -> None:
+        """Report a single change, text is what ends up in the digest"""
+        if self.mode == "per-change":
+            if blocks:
+                self._post(text=text, blocks=blocks)
+            else:
+                self._post(text=text)
+        elif self.mode == "digest":
+            with self.lock:
+                self.lines.append(text)
+
+    def flush(self) -> None:
+        """Post everything collected so far as a digest, a no-op outside digest mode"""
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if not lines:
+            return
+        messages = digest_messages(self.title, lines)
+        logging.debug(
+            f"Posting {len(lines)} changes in {len(messages)} digest messages"
+        )
+        for blocks in messages:
+            self._post(text=f"{self.title}: {len(lines)} changes", blocks=blocks)
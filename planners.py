@@ -0,0 +1,715 @@
+"""Work out what needs to change in Slack based on TidyHQ.
+
+These are shared by slack_badges.py, slack_titles.py, sync_channels.py and
+reconcile.py. Nothing in here writes to either system, planners take already
+loaded TidyHQ/Slack state and return the changes that should be made. Channel
+member lists are loaded (and cached) here too as nothing else needs them.
+"""
+
+import gzip
+import json
+import logging
+import random
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any
+
+import helpers
+import rate_limit
+from slack_directory import SlackDirectory
+from tidyhq import ContactIndex
+
+CHANNEL_CACHE_PATH = "slack_channel_members.json.gz"
+
+# Long enough to cover a dry run followed by a --live run
+CHANNEL_CACHE_TTL = 10 * 60
+
+# conversations.members accepts up to 1000 per page
+CHANNEL_PAGE_SIZE = 1000
+
+
+def badge_contacts(config: dict[str, Any], contacts: ContactIndex) -> dict[str, Any]:
+    """Linked contacts that should have a badge, keyed by Slack ID"""
+    ids = config["tidyhq"]["ids"]
+    members = contacts.group_set(ids["members"])
+    committees = contacts.group_set(ids["committee"])
+    inductions = contacts.group_set(ids["member_induction"])
+    volunteers = contacts.group_set(ids["volunteer"])
+    ignore = set(config["slack"]["membership_ignore"])
+
+    c = {}
+    # This script only deals with people that are linked in Slack
+    for slack, contact in contacts.by_slack.items():
+        if contact["id"] in ignore:
+            continue
+
+        # Check for relevant user groups
+        member = contacts.in_any(contact["id"], members)
+        committee = contacts.in_any(contact["id"], committees)
+        member_induction = contacts.in_any(contact["id"], inductions)
+        volunteer = contacts.in_any(contact["id"], volunteers)
+
+        # Check for relevant custom fields
+        volunteer_dates = contacts.field(contact["id"], ids.get("volunteer_field"))
+        if volunteer_dates:
+            # This field is a comma separated list of dates stored as YYMM
+            dates = [x.strip() for x in volunteer_dates.split(",")]
+            for date in dates:
+                parsed_date = datetime.strptime(date, "%y%m")
+
+                # Mark the user as a volunteer if the date is this or last month
+                # Yes this could be checked with int comparisons but this seems more readable
+                if parsed_date.year == datetime.now().year and parsed_date.month in [
+                    datetime.now().month,
+                    datetime.now().month - 1,
+                ]:
+                    volunteer = True
+
+        if member or committee or volunteer:
+            c[slack] = {
+                "id": contact["id"],
+                "name": contact["display_name"],
+                "member": member,
+                "committee": committee,
+                "member_induction": member_induction,
+                "volunteer": volunteer,
+            }
+    return c
+
+
+def badge_slack_users(directory: SlackDirectory) -> dict[str, Any]:
+    c = {}
+    for user in directory.humans():
+        c[user["id"]] = {
+            "emoji": user["profile"].get("status_emoji", False),
+            "text": user["profile"].get("status_text", False),
+        }
+    return c
+
+
+def plan_badges(
+    config: dict[str, Any], tidyhq_users: dict[str, Any], slack_users: dict[str, Any]
+) -> dict[str, dict[str, Any]]:
+    """Badge changes keyed by Slack ID, {"text": None} means the badge should be removed"""
+    changes: dict[str, dict[str, Any]] = {}
+    overrides = {x["user"] for x in config["slack"].get("status_override", [])}
+
+    # Iterate over Slack users to find ones that have a status when we don't expect it
+    for slack_user in slack_users:
+        # Skip users in the override list
+        if slack_user in overrides:
+            continue
+
+        # Users that aren't in tidyhq wouldn't get their status fixed in the next step so strip them now
+        if slack_user not in tidyhq_users:
+            # Check if they have a status to remove
+            if slack_users[slack_user]["text"] or slack_users[slack_user]["emoji"]:
+                logging.info(
+                    f'Removing status "{slack_users[slack_user]["text"]}" from {slack_user}'
+                )
+                changes[slack_user] = {"text": None}
+
+    for tidyhq_user in tidyhq_users:
+        name = f"{tidyhq_users[tidyhq_user]['name']} ({tidyhq_user}/{tidyhq_users[tidyhq_user]['id']})"
+
+        # Check if user is present in both systems
+        if tidyhq_user not in slack_users:
+            logging.warning(f"{name} is in TidyHQ but not in Slack")
+            continue
+
+        emoji = None
+        title = None
+
+        if tidyhq_users[tidyhq_user]["committee"]:
+            emoji = config["slack"]["status"]["Committee"]
+            title = "Committee"
+        elif tidyhq_users[tidyhq_user]["volunteer"]:
+            emoji = config["slack"]["status"]["Volunteer"]
+            title = "Volunteer"
+        elif tidyhq_users[tidyhq_user]["member"]:
+            # Check for a member induction
+            emoji = config["slack"]["status"]["Uninducted"]
+            if tidyhq_users[tidyhq_user]["member_induction"]:
+                emoji = config["slack"]["status"]["Member"]
+            title = "Member"
+
+        if title:
+            # Check if the status is already set correctly
+            if (
+                slack_users[tidyhq_user]["text"] == title
+                and slack_users[tidyhq_user]["emoji"] == emoji
+            ):
+                logging.debug(f"{name} is already marked as {title}")
+            else:
+                changes[tidyhq_user] = {"text": title, "emoji": emoji}
+                logging.info(f"Setting badge for {name} as {title}")
+
+    # Process overrides
+    for override in config["slack"].get("status_override", []):
+        if override["user"] not in slack_users:
+            logging.warning(f"User {override['user']} not found in Slack")
+            continue
+        # Check if the user already has the correct title
+        if (
+            slack_users[override["user"]]["text"] == override["status"]
+            and slack_users[override["user"]]["emoji"]
+            == config["slack"]["status"][override["status"]]
+        ):
+            logging.debug(
+                f"{override['user']} is already marked as {override['status']}"
+            )
+            # Don't let an automatic status replace it
+            changes.pop(override["user"], None)
+        else:
+            changes[override["user"]] = {"text": override["status"]}
+            logging.info(
+                f"Setting badge for {override['user']} as {override['status']} due to a hardcoded override. (config.json)"
+            )
+    return changes
+
+
+def badge_profile(
+    config: dict[str, Any], text: str | None = None, emoji: str | None = None
+) -> dict[str, Any]:
+    """Profile fields for a planned badge change, the emoji comes from config.json if not given"""
+    if not text:
+        text = ""
+        emoji = ""
+    elif emoji and text:
+        # Emoji is already set
+        pass
+    elif text not in config["slack"]["status"]:
+        raise ValueError(f"Invalid status: {text}")
+    else:
+        emoji = config["slack"]["status"][text]
+
+    return {
+        "status_text": text,
+        "status_emoji": emoji,
+        "status_expiration": 0,
+    }
+
+
+def title_contacts(config: dict[str, Any], contacts: ContactIndex) -> dict[str, Any]:
+    """Linked contacts with a title, keyed by Slack ID"""
+    ignore = set(config["slack"]["membership_ignore"])
+    c = {}
+    # This script only deals with people that are linked in Slack
+    for slack, contact in contacts.by_slack.items():
+        if contact["id"] in ignore:
+            continue
+        title: str = contacts.field(contact["id"], config["tidyhq"]["ids"]["title"])
+
+        # We only care about people with titles
+        if title:
+            c[slack] = {
+                "id": contact["id"],
+                "name": contact["display_name"],
+                "title": title,
+            }
+    return c
+
+
+def title_slack_users(directory: SlackDirectory) -> dict[str, Any]:
+    c: dict = {}
+    for user in directory.humans():
+        c[user["id"]] = {
+            "title": user["profile"].get("title", False),
+            "real_name": user["profile"].get("real_name", False),
+            "display_name": user["profile"].get("display_name", False),
+        }
+    return c
+
+
+def plan_titles(
+    tidyhq_users: dict[str, Any], slack_users: dict[str, Any]
+) -> dict[str, str]:
+    """Title changes keyed by Slack ID, an empty title means it should be removed"""
+    changes: dict[str, str] = {}
+
+    # Iterate over slack users to find ones that have a title when we don't expect it
+    for slack_user in slack_users:
+        # Skip people that will have titles updated in the next step
+        if slack_user in tidyhq_users:
+            continue
+
+        if slack_users[slack_user]["title"]:
+            changes[slack_user] = ""
+
+    for tidyhq_user in tidyhq_users:
+        if tidyhq_user not in slack_users:
+            logging.warning(
+                f"{tidyhq_users[tidyhq_user]['name']} ({tidyhq_user}) is in TidyHQ but not in Slack"
+            )
+            continue
+
+        # Check if their title is already correct
+        if tidyhq_users[tidyhq_user]["title"] == slack_users[tidyhq_user]["title"]:
+            continue
+
+        changes[tidyhq_user] = tidyhq_users[tidyhq_user]["title"]
+    return changes
+
+
+def channel_contacts(config: dict[str, Any], contacts: ContactIndex) -> dict[str, Any]:
+    """Linked contacts with their groups, keyed by Slack ID"""
+    members = contacts.group_set(config["tidyhq"]["ids"]["members"])
+    ignore = set(config["slack"]["membership_ignore"])
+    c = {}
+    # This script only deals with people that are linked in Slack
+    for slack, contact in contacts.by_slack.items():
+        if contact["id"] in ignore:
+            continue
+
+        c[slack] = {
+            "id": contact["id"],
+            "name": contact["display_name"],
+            "member": contacts.in_any(contact["id"], members),
+            "groups": contacts.contact_groups[str(contact["id"])],
+        }
+    return c
+
+
+# Operators in channel rules, anything else (or anything in double quotes) is a name
+RULE_TOKEN = re.compile(r'\s*(?:([&|!()])|"([^"]*)"|([^&|!()"]+))')
+
+# Names in channel rules that aren't TidyHQ groups
+RULE_FLAGS = {"member", "linked"}
+
+
+class ChannelRule:
+    """A boolean expression over TidyHQ groups, eg (Laser | committee) & member & !suspended
+
+    The text is parsed once into postfix operations that run over bitsets from a
+    MembershipModel, so evaluating a rule costs a few big-int operations no matter how
+    many users there are. Names are TidyHQ group labels (case insensitive) or IDs, or
+    one of RULE_FLAGS. ! is relative to every linked contact.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.ops: list[tuple[str, str | None]] = []
+        self.tokens = self._tokenise(text)
+        self._expression()
+        if self.tokens:
+            raise ValueError(f"Unexpected {self.tokens[0][1]!r} in rule: {text}")
+        del self.tokens
+        self.names = {value for op, value in self.ops if op == "name"}
+
+    def __repr__(self) -> str:
+        return f"ChannelRule({self.text!r})"
+
+    def _tokenise(self, text: str) -> list[tuple[str, str]]:
+        tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = RULE_TOKEN.match(text, position)
+            if not match:
+                raise ValueError(f"Unterminated quote in rule: {text}")
+            operator, quoted, bare = match.groups()
+            if operator:
+                tokens.append(("op", operator))
+            elif quoted is not None:
+                tokens.append(("name", quoted))
+            elif bare.strip():
+                tokens.append(("name", bare.strip()))
+            position = match.end()
+        return tokens
+
+    def _expression(self) -> None:
+        self._term()
+        while self.tokens and self.tokens[0] == ("op", "|"):
+            self.tokens.pop(0)
+            self._term()
+            self.ops.append(("or", None))
+
+    def _term(self) -> None:
+        self._factor()
+        while self.tokens and self.tokens[0] == ("op", "&"):
+            self.tokens.pop(0)
+            self._factor()
+            self.ops.append(("and", None))
+
+    def _factor(self) -> None:
+        if not self.tokens:
+            raise ValueError(f"Rule ends early: {self.text}")
+        kind, value = self.tokens.pop(0)
+        if kind == "name":
+            self.ops.append(("name", value))
+        elif value == "!":
+            self._factor()
+            self.ops.append(("not", None))
+        elif value == "(":
+            self._expression()
+            if not self.tokens or self.tokens.pop(0) != ("op", ")"):
+                raise ValueError(f"Missing ) in rule: {self.text}")
+        else:
+            raise ValueError(f"Unexpected {value!r} in rule: {self.text}")
+
+    def evaluate(self, sets: dict[str, int], universe: int) -> int:
+        """Bitset of users matching the rule, sets has a bitset for every name"""
+        stack: list[int] = []
+        for op, value in self.ops:
+            if op == "name":
+                stack.append(sets[value])  # type: ignore[index]
+            elif op == "not":
+                stack.append(universe & ~stack.pop())
+            else:
+                right = stack.pop()
+                if op == "and":
+                    stack[-1] &= right
+                else:
+                    stack[-1] |= right
+        return stack[0]
+
+
+def load_channel_mapping(path: str = "synced_channels.json") -> dict[str, Any]:
+    with open(path, "r") as f:
+        channel_mapping_raw = json.load(f)
+
+    map_by_channel: dict[str, list[str]] = {}
+    map_by_group: dict[str, list[str]] = {}
+
+    for group in channel_mapping_raw.get("by_tidyhq", {}):
+        for channel in channel_mapping_raw["by_tidyhq"][group]:
+            if channel not in map_by_channel:
+                map_by_channel[channel] = []
+            map_by_channel[channel].append(group)
+
+        if group not in map_by_group:
+            map_by_group[group] = []
+        map_by_group[group].extend(channel_mapping_raw["by_tidyhq"][group])
+
+    for channel in channel_mapping_raw.get("by_channel", {}):
+        for group in channel_mapping_raw["by_channel"][channel]:
+            if channel not in map_by_channel:
+                map_by_channel[channel] = []
+            map_by_channel[channel].append(group)
+
+        for group in channel_mapping_raw["by_channel"][channel]:
+            if group not in map_by_group:
+                map_by_group[group] = []
+            map_by_group[group].append(channel)
+
+    # Everything becomes a rule, the group lists are just rules with a single group
+    rules: dict[str, list[ChannelRule]] = {}
+    for channel, groups in map_by_channel.items():
+        for group in groups:
+            rules.setdefault(channel, []).append(ChannelRule(f'"{group}"'))
+    for channel in channel_mapping_raw.get("members", []):
+        rules.setdefault(channel, []).append(ChannelRule("member"))
+    for channel, channel_rules in channel_mapping_raw.get("rules", {}).items():
+        if isinstance(channel_rules, str):
+            channel_rules = [channel_rules]
+        for rule in channel_rules:
+            rules.setdefault(channel, []).append(ChannelRule(rule))
+
+    return {
+        "by_channel": map_by_channel,
+        "by_group": map_by_group,
+        "members": channel_mapping_raw.get("members", []),
+        "rules": rules,
+    }
+
+
+def mapped_channels(mapping: dict[str, Any]) -> list[str]:
+    return list(mapping["rules"])
+
+
+class ChannelMemberCache:
+    """Channel member lists kept on disk for a short time so dry runs and --live runs can share them"""
+
+    def __init__(self, path: str = CHANNEL_CACHE_PATH, ttl: float = CHANNEL_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.channels: dict[str, dict[str, Any]] = {}
+        try:
+            with gzip.open(self.path, "rt") as f:
+                self.channels = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.warning(f"Ignoring unreadable channel cache {self.path}")
+
+    def get(self, channel: str) -> list[str] | None:
+        cached = self.channels.get(channel)
+        if cached and time.time() - cached["fetched_at"] <= self.ttl:
+            return cached["members"]
+        return None
+
+    def put(self, channel: str, members: list[str]) -> None:
+        self.channels[channel] = {"fetched_at": time.time(), "members": members}
+
+    def add_members(self, channel: str, users: list[str]) -> None:
+        """Record users we've invited so the cached list doesn't go stale"""
+        if channel in self.channels:
+            known = set(self.channels[channel]["members"])
+            self.channels[channel]["members"].extend(u for u in users if u not in known)
+
+    def remove_members(self, channel: str, users: list[str]) -> None:
+        if channel in self.channels:
+            gone = set(users)
+            self.channels[channel]["members"] = [
+                u for u in self.channels[channel]["members"] if u not in gone
+            ]
+
+    def save(self) -> None:
+        helpers.write_json(self.path, self.channels, compress=True)
+
+
+def channel_cache(config: dict[str, Any]) -> ChannelMemberCache:
+    settings = config["slack"].get("channel_cache", {})
+    return ChannelMemberCache(
+        path=settings.get("path", CHANNEL_CACHE_PATH),
+        ttl=settings.get("ttl", CHANNEL_CACHE_TTL),
+    )
+
+
+def fetch_channel_members(client, channel: str) -> list[str]:
+    """Page through conversations.members for one channel"""
+    limiter = rate_limit.scheduler()
+    channel_members = []
+    cursor = None
+    while True:
+        response = limiter.slack(
+            client,
+            "conversations_members",
+            channel=channel,
+            cursor=cursor,
+            limit=CHANNEL_PAGE_SIZE,
+        )
+        channel_members.extend(response["members"])
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return channel_members
+
+
+def get_channel_members(
+    client,
+    channels: list[str],
+    cache: ChannelMemberCache | None = None,
+    workers: int = 8,
+) -> dict[str, list[str]]:
+    """Members of every channel, fetched in parallel within the conversations.members budget
+
+    A channel that fails is logged and left out rather than stopping the others.
+    """
+    members = {}
+    to_fetch = []
+    for channel in channels:
+        cached = cache.get(channel) if cache else None
+        if cached is None:
+            to_fetch.append(channel)
+        else:
+            logging.debug(f"Using cached members for #{channel}")
+            members[channel] = cached
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch_channel_members, client, channel): channel
+            for channel in to_fetch
+        }
+        for future in as_completed(futures):
+            channel = futures[future]
+            try:
+                channel_members = future.result()
+            except Exception as e:
+                logging.error(f"Error getting members for channel {channel}: {e}")
+                failures[channel] = str(e)
+                continue
+            logging.info(f"Got info for #{channel} with {len(channel_members)} members")
+            members[channel] = channel_members
+            if cache:
+                cache.put(channel, channel_members)
+
+    if cache and to_fetch:
+        cache.save()
+
+    logging.info(f"Loaded members for {len(members)} channels")
+    if failures:
+        logging.warning(
+            f"Could not load members for {len(failures)} channels: {', '.join(failures)}"
+        )
+    return members
+
+
+class MembershipModel:
+    """Sets of Slack users stored as int bitsets over a dense user index
+
+    Unions, intersections and differences of whole groups/channels become a handful of
+    big-int operations instead of per-user list lookups, which keeps diffing hundreds of
+    channels against tens of thousands of users cheap.
+    """
+
+    def __init__(self) -> None:
+        self.users: list[str] = []
+        self.position: dict[str, int] = {}
+
+    def add(self, user: str) -> int:
+        if user not in self.position:
+            self.position[user] = len(self.users)
+            self.users.append(user)
+        return self.position[user]
+
+    def bits(self, users) -> int:
+        """Bitset of users, adding any we haven't seen to the index"""
+        positions = [self.add(user) for user in users]
+        if not positions:
+            return 0
+        # Setting bits in a bytearray and converting once is linear, OR-ing 1 << i isn't
+        buffer = bytearray(max(positions) // 8 + 1)
+        for i in positions:
+            buffer[i >> 3] |= 1 << (i & 7)
+        return int.from_bytes(buffer, "little")
+
+    def ids(self, bits: int) -> list[str]:
+        users = []
+        data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        for byte_index, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                users.append(self.users[byte_index * 8 + low.bit_length() - 1])
+                byte ^= low
+        return users
+
+
+def resolve_rule_names(
+    names: set[str], groups: set[str], labels: dict[str, str]
+) -> dict[str, list[str]]:
+    """Map names used in rules to the group IDs they refer to
+
+    Flags map to themselves, names that don't match anything are left out.
+    """
+    by_label: dict[str, list[str]] = {}
+    for group_id, label in labels.items():
+        by_label.setdefault(label.strip().lower(), []).append(group_id)
+
+    resolved = {}
+    for name in names:
+        if name.lower() in RULE_FLAGS:
+            resolved[name] = [name.lower()]
+        elif name in groups or name in labels:
+            resolved[name] = [name]
+        elif name.strip().lower() in by_label:
+            resolved[name] = by_label[name.strip().lower()]
+    return resolved
+
+
+def plan_channels(
+    contacts: dict[str, Any],
+    mapping: dict[str, Any],
+    channels: dict[str, list[str]],
+    removals: bool = False,
+    labels: dict[str, str] | None = None,
+) -> dict[str, dict[str, list[str]]]:
+    """Users to invite (and optionally remove) keyed by channel
+
+    Only linked contacts are ever removed, anyone in a channel that we can't see in TidyHQ
+    (guests, bots etc) is left alone. labels (group ID to label) lets rules refer to
+    groups by name.
+    """
+    model = MembershipModel()
+    linked = model.bits(contacts)
+
+    rules: dict[str, list[ChannelRule]] = mapping["rules"]
+    names: set[str] = set()
+    for channel_rules in rules.values():
+        for rule in channel_rules:
+            names |= rule.names
+
+    # Only build bitsets for the groups rules actually use
+    group_members: dict[str, list[str]] = {}
+    for contact in contacts:
+        for group in contacts[contact]["groups"]:
+            group_members.setdefault(group, []).append(contact)
+    resolved = resolve_rule_names(names, set(group_members), labels or {})
+    wanted = {group for ids in resolved.values() for group in ids}
+    sets_by_id = {
+        group: model.bits(users)
+        for group, users in group_members.items()
+        if group in wanted
+    }
+    sets_by_id["member"] = model.bits(c for c in contacts if contacts[c]["member"])
+    sets_by_id["linked"] = linked
+
+    sets: dict[str, int] = {}
+    for name, ids in resolved.items():
+        bits = 0
+        for group in ids:
+            bits |= sets_by_id.get(group, 0)
+        sets[name] = bits
+
+    logging.info(f"Loaded {len(group_members)} groups from TidyHQ")
+
+    invite: dict[str, list[str]] = {}
+    kick: dict[str, list[str]] = {}
+    for channel, channel_members in channels.items():
+        desired = 0
+        complete = True
+        for rule in rules.get(channel, []):
+            if missing := rule.names - sets.keys():
+                # Treating an unknown group as empty could make a negated rule match everyone
+                logging.error(
+                    f"Skipping rule {rule.text} for #{channel}, no group called {', '.join(sorted(missing))}"
+                )
+                complete = False
+                continue
+            desired |= rule.evaluate(sets, linked)
+
+        current = model.bits(channel_members)
+        if to_add := desired & ~current:
+            invite[channel] = model.ids(to_add)
+        if removals and not complete:
+            # Without every rule we don't know who should be there, so a typo in one
+            # label can't empty the channel
+            logging.error(
+                f"Not removing anyone from #{channel} until its rules resolve"
+            )
+        elif removals and (to_remove := current & linked & ~desired):
+            kick[channel] = model.ids(to_remove)
+    return {"invite": invite, "kick": kick}
+
+
+def benchmark(users: int = 50000, channels: int = 500, groups: int = 200) -> None:
+    """Time plan_channels against a synthetic workspace"""
+    random.seed(1)
+    group_ids = [str(g) for g in range(groups)]
+    contacts = {
+        f"U{i}": {
+            "member": random.random() < 0.6,
+            "groups": frozenset(random.sample(group_ids, random.randint(0, 5))),
+        }
+        for i in range(users)
+    }
+    user_ids = list(contacts)
+    channel_ids = [f"C{c}" for c in range(channels)]
+    rules: dict[str, list[ChannelRule]] = {
+        c: [ChannelRule("member")] for c in channel_ids[:10]
+    }
+    for c in channel_ids[10:]:
+        a, b, d = random.sample(group_ids, 3)
+        rules[c] = [ChannelRule(f"({a} | {b}) & member & !{d}")]
+    mapping = {"rules": rules}
+    members = {
+        c: random.sample(user_ids, random.randint(0, users // 10)) for c in channel_ids
+    }
+
+    started = time.perf_counter()
+    plan = plan_channels(contacts, mapping, members, removals=True)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{users} users, {channels} channels: "
+        f"{sum(map(len, plan['invite'].values()))} invites, "
+        f"{sum(map(len, plan['kick'].values()))} removals in {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    # python planners.py [users] [channels]
+    logging.basicConfig(level=logging.WARNING)
+    benchmark(*(int(arg) for arg in sys.argv[1:3]))
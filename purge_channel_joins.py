@@ -2,13 +2,13 @@
 import json
 import logging
 import sys
-import time
 from datetime import datetime
 from pprint import pprint
 
 from slack_bolt import App
 
-import errors
+import rate_limit
+import slack_directory
 
 # Check for --debug flag
 if len(sys.argv) > 1 and "--debug" in sys.argv:
@@ -22,6 +22,7 @@ with open("config.json", "r") as f:
 
 # Initiate Slack client
 app = App(token=config["slack"]["user_token"])
+limiter = rate_limit.scheduler()
 
 # Get info for our Slack connection
 slack_info = app.client.auth_test()  # type: ignore
@@ -34,15 +35,19 @@ messages = response["messages"]
 # pprint(messages)
 print(f"Found {len(messages)} messages in channel {channel_id}")
 
+directory = slack_directory.load(app.client, config)
 name_map = {}
 
 for message in messages:
     # Translate user IDs to usernames
     if "user" in message and message["user"] not in name_map:
-        response = app.client.users_info(user=message["user"])
-        name = response["user"]["profile"]["display_name"]
-        if name == "":
-            name = response["user"]["name"]
+        name = directory.name(message["user"])
+        # Users from other workspaces won't be in our directory
+        if name is None:
+            response = app.client.users_info(user=message["user"])
+            name = response["user"]["profile"]["display_name"]
+            if name == "":
+                name = response["user"]["name"]
         name_map[message["user"]] = name
     else:
         name = name_map[message["user"]]
@@ -50,13 +55,9 @@ for message in messages:
     # Delete channel join messages
     if message.get("subtype") == "channel_join":
         print(f"Deleting channel join message from {name} ({message['user']})")
-        try:
-            response = app.client.chat_delete(channel=channel_id, ts=message["ts"])
-        except Exception as e:
-            if "ratelimited" in str(e):
-                print(errors.rate_limit)
-                time.sleep(60)
-                response = app.client.chat_delete(channel=channel_id, ts=message["ts"])
+        response = limiter.slack(
+            app.client, "chat_delete", channel=channel_id, ts=message["ts"]
+        )
         continue
 
     # Delete messages where the root message has been deleted
@@ -72,14 +73,6 @@ for message in messages:
             if reply["user"] == "USLACKBOT":
                 continue
             print(f"Deleting reply from {reply['user']}")
-            try:
-                response = app.client.chat_delete(channel=channel_id, ts=reply["ts"])
-            except Exception as e:
-                if "ratelimited" in str(e):
-                    print(errors.rate_limit)
-                    time.sleep(60)
-                    response = app.client.chat_delete(
-                        channel=channel_id, ts=reply["ts"]
-                    )
-                else:
-                    raise e
+            response = limiter.slack(
+                app.client, "chat_delete", channel=channel_id, ts=reply["ts"]
+            )
@@ -0,0 +1,198 @@
+"""Shared rate limit scheduler for Slack and TidyHQ calls.
+
+Every method gets a token bucket sized from its Slack rate tier (or our own limit
+for TidyHQ) so calls go out as fast as the budget allows instead of sleeping a
+fixed amount after each one. A 429 pauses the bucket for the Retry-After period,
+halves its rate and the call is retried. The rate then creeps back up to the
+configured limit as calls succeed.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+import requests
+from slack_sdk.errors import SlackApiError
+
+# Requests per minute for each Slack rate tier https://api.slack.com/apis/rate-limits
+SLACK_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+SLACK_METHOD_TIERS = {
+    "chat.delete": 3,
+    "conversations.history": 3,
+    "conversations.invite": 3,
+    "conversations.kick": 3,
+    "conversations.members": 4,
+    "conversations.replies": 3,
+    "files.completeUploadExternal": 4,
+    "files.getUploadURLExternal": 4,
+    "pins.add": 2,
+    "users.info": 4,
+    "users.list": 2,
+    "users.profile.set": 3,
+}
+
+# Methods with their own limits that don't follow the tiers, in requests per minute
+METHOD_LIMITS = {
+    # Roughly one message per second per channel
+    "chat.postMessage": 60,
+    # Tier 3 on paper but in practice ~30 changes a minute before Slack pushes back
+    "users.profile.set": 30,
+    # TidyHQ doesn't publish a limit, this keeps us at the pace that has historically been safe
+    "tidyhq": 60,
+}
+
+DEFAULT_TIER = 3
+
+# How many times a rate limited call is retried before giving up
+MAX_RETRIES = 5
+
+# After a 429 a bucket drops to this fraction of its rate (but never below MIN_RATE per
+# minute) and gets RECOVERY of its configured rate back for every successful call
+BACKOFF_FACTOR = 0.5
+MIN_RATE = 1
+RECOVERY = 0.02
+
+# Workers that hit the same 429 together only slow the bucket down once
+THROTTLE_WINDOW = 2
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: float | None = None) -> None:
+        self.rate = per_minute / 60
+        self.max_rate = self.rate
+        self.capacity = burst if burst is not None else max(1, per_minute // 2)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.throttled_at = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        """Block until a call can be made"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out tokens for a while, typically because of a Retry-After"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def throttle(self) -> None:
+        """Slow down after being rate limited"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.throttled_at < THROTTLE_WINDOW:
+                return
+            self.throttled_at = now
+            self._refill(now)
+            self.rate = max(MIN_RATE / 60, self.rate * BACKOFF_FACTOR)
+        logging.debug(f"Slowed to {self.rate * 60:.1f} requests per minute")
+
+    def recover(self) -> None:
+        """Speed back up towards the configured rate after a successful call"""
+        if self.rate < self.max_rate:
+            with self.lock:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY)
+
+
+def retry_after(result: Any) -> float | None:
+    """Get the Retry-After of a rate limited response or exception, None if it wasn't rate limited"""
+    if isinstance(result, SlackApiError):
+        result = result.response
+    status = getattr(result, "status_code", None)
+    if status != 429:
+        return None
+    headers = getattr(result, "headers", {}) or {}
+    try:
+        return float(headers.get("Retry-After", headers.get("retry-after", 60)))
+    except (TypeError, ValueError):
+        return 60
+
+
+def was_throttled(result: Any) -> bool:
+    """Whether a response only succeeded after urllib3 retried a 429 for us"""
+    retries = getattr(getattr(result, "raw", None), "retries", None)
+    history = getattr(retries, "history", None) or ()
+    return any(getattr(attempt, "status", None) == 429 for attempt in history)
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self.buckets: dict[str, TokenBucket] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, method: str) -> TokenBucket:
+        with self.lock:
+            if method not in self.buckets:
+                if method in METHOD_LIMITS:
+                    per_minute = METHOD_LIMITS[method]
+                else:
+                    per_minute = SLACK_TIERS[
+                        SLACK_METHOD_TIERS.get(method, DEFAULT_TIER)
+                    ]
+                self.buckets[method] = TokenBucket(per_minute)
+            return self.buckets[method]
+
+    def call(
+        self, method: str, func: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        """Run func once the bucket for method allows it, retrying if we get rate limited anyway"""
+        bucket = self.bucket(method)
+        for attempt in range(MAX_RETRIES + 1):
+            bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except SlackApiError as e:
+                wait = retry_after(e)
+                if wait is None or attempt == MAX_RETRIES:
+                    raise
+            else:
+                wait = retry_after(result)
+                if wait is None:
+                    # The HTTP layer may have already retried a 429 for us
+                    if was_throttled(result):
+                        bucket.throttle()
+                    else:
+                        bucket.recover()
+                    return result
+                if attempt == MAX_RETRIES:
+                    return result
+            logging.warning(f"Rate limited on {method}, waiting {wait} seconds")
+            bucket.throttle()
+            bucket.pause(wait)
+
+    def slack(self, client, method: str, **kwargs: Any) -> Any:
+        """Call a Slack Web API method, eg slack(app.client, "users_profile_set", ...)"""
+        return self.call(method.replace("_", "."), getattr(client, method), **kwargs)
+
+    def tidyhq(
+        self, func: Callable[..., requests.Response], *args: Any, **kwargs: Any
+    ) -> requests.Response:
+        """Call a TidyHQ client method, eg tidyhq(tidy.put, "contacts/1", ...)"""
+        return self.call("tidyhq", func, *args, **kwargs)
+
+
+_scheduler = Scheduler()
+
+
+def scheduler() -> Scheduler:
+    """Get the process wide scheduler so every call site shares the same budgets"""
+    return _scheduler
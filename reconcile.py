@@ -0,0 +1,288 @@
+# Reconcile Slack badges, titles and channel memberships against TidyHQ in one pass
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any
+
+import requests
+from slack_bolt import App
+from slack_sdk.errors import SlackApiError
+
+import channel_writer
+import errors
+import helpers
+import notifications
+import planners
+import rate_limit
+import slack_directory
+import tidyhq
+
+
+def build_plan(
+    config: dict[str, Any],
+    contacts: tidyhq.ContactIndex,
+    directory: slack_directory.SlackDirectory,
+    client,
+    mapping: dict[str, Any] | None,
+    channel_cache: planners.ChannelMemberCache | None = None,
+    removals: bool = False,
+) -> dict[str, Any]:
+    """Run every planner over the same TidyHQ/Slack state"""
+    badges = planners.plan_badges(
+        config,
+        planners.badge_contacts(config, contacts),
+        planners.badge_slack_users(directory),
+    )
+    titles = planners.plan_titles(
+        planners.title_contacts(config, contacts),
+        planners.title_slack_users(directory),
+    )
+
+    # Badges and titles live on the same profile so each user only needs one write
+    profiles: dict[str, dict[str, Any]] = {}
+    for slack_id, change in badges.items():
+        profiles[slack_id] = planners.badge_profile(config, **change)
+    for slack_id, title in titles.items():
+        profiles.setdefault(slack_id, {})["title"] = title
+
+    channel_plan: dict[str, dict[str, list[str]]] = {"invite": {}, "kick": {}}
+    if mapping:
+        channels = planners.get_channel_members(
+            client, planners.mapped_channels(mapping), cache=channel_cache
+        )
+        channel_plan = planners.plan_channels(
+            planners.channel_contacts(config, contacts),
+            mapping,
+            channels,
+            removals=removals,
+            labels=contacts.group_labels,
+        )
+
+    return {
+        "profiles": profiles,
+        "invites": channel_plan["invite"],
+        "kicks": channel_plan["kick"],
+    }
+
+
+def describe(slack_id: str, profile: dict[str, Any]) -> str:
+    changes = []
+    if "status_text" in profile:
+        if profile["status_text"]:
+            changes.append(
+                f"badge {profile['status_emoji']} {profile['status_text']}".strip()
+            )
+        else:
+            changes.append("remove badge")
+    if "title" in profile:
+        if profile["title"]:
+            changes.append(f'title "{profile["title"]}"')
+        else:
+            changes.append("remove title")
+    return f"<@{slack_id}>: {', '.join(changes)}"
+
+
+def set_profile(
+    client,
+    limiter: rate_limit.Scheduler,
+    directory: slack_directory.SlackDirectory,
+    notifier: notifications.Notifier,
+    slack_id: str,
+    profile: dict[str, Any],
+) -> None:
+    limiter.slack(client, "users_profile_set", user=slack_id, profile=profile)
+    directory.update_profile(
+        slack_id, **{k: v for k, v in profile.items() if k != "status_expiration"}
+    )
+    notifier.notify(f"Updated {describe(slack_id, profile)}")
+
+
+def invite(
+    client,
+    channel_cache: planners.ChannelMemberCache,
+    notifier: notifications.Notifier,
+    channel: str,
+    users: list[str],
+) -> dict[str, str]:
+    try:
+        failed = channel_writer.invite_users(client, channel, users)
+    except SlackApiError as e:
+        channel_cache.add_members(channel, getattr(e, "done", []))
+        raise
+    invited = [user for user in users if user not in failed]
+    channel_cache.add_members(channel, invited)
+    notifier.notify(f"Invited {len(invited)} to <#{channel}>")
+    return failed
+
+
+def kick(
+    client,
+    channel_cache: planners.ChannelMemberCache,
+    notifier: notifications.Notifier,
+    channel: str,
+    users: list[str],
+) -> dict[str, str]:
+    try:
+        failed = channel_writer.kick_users(client, channel, users)
+    except SlackApiError as e:
+        channel_cache.remove_members(channel, getattr(e, "done", []))
+        raise
+    kicked = [user for user in users if user not in failed]
+    channel_cache.remove_members(channel, kicked)
+    notifier.notify(f"Removed {len(kicked)} from <#{channel}>")
+    return failed
+
+
+def execute(
+    plan: dict[str, Any],
+    client,
+    limiter: rate_limit.Scheduler,
+    directory: slack_directory.SlackDirectory,
+    notifier: notifications.Notifier,
+    channel_cache: planners.ChannelMemberCache,
+    workers: int = 4,
+) -> dict[str, list[tuple[str, str]]]:
+    """Apply the plan through the shared rate limiter, returning what failed
+
+    Failures are split into "profiles" and "channels", one entry per user either way
+    so they can be counted against the plan.
+    """
+    failures: dict[str, list[tuple[str, str]]] = {"profiles": [], "channels": []}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for slack_id, profile in plan["profiles"].items():
+            future = pool.submit(
+                set_profile, client, limiter, directory, notifier, slack_id, profile
+            )
+            futures[future] = ("profiles", slack_id, [slack_id])
+        for write, batches in ((invite, plan["invites"]), (kick, plan["kicks"])):
+            for channel, users in batches.items():
+                future = pool.submit(
+                    write, client, channel_cache, notifier, channel, users
+                )
+                futures[future] = ("channels", f"#{channel}", users)
+        for future in as_completed(futures):
+            kind, target, users = futures[future]
+            try:
+                failed = future.result() or {}
+            except SlackApiError as e:
+                logging.error(f"Failed to update {target}: {e.response['error']}")
+                done = set(getattr(e, "done", []))
+                failed = {
+                    user: e.response["error"] for user in users if user not in done
+                }
+            for user, error in failed.items():
+                if kind == "channels":
+                    logging.error(f"Failed to update {user} in {target}: {error}")
+                    user = f"{user} in {target}"
+                failures[kind].append((user, error))
+    return failures
+
+
+if __name__ == "__main__":
+    # Check for --debug flag
+    if len(sys.argv) > 1 and "--debug" in sys.argv:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    # load config from file
+    with open("config.json", "r") as f:
+        config = json.load(f)
+
+    # Initiate Slack clients
+    app = App(token=config["slack"]["user_token"])
+    bot_app = App(token=config["slack"]["bot_token"])
+    limiter = rate_limit.scheduler()
+    notifier = notifications.Notifier(
+        bot_app.client,
+        channel=config["slack"]["notification_channel"],
+        title="Slack reconcile",
+        mode=notifications.mode_arg(default="digest"),
+        username="Slack Reconcile",
+        icon_emoji=":artifactory:",
+    )
+
+    slack_info = app.client.auth_test()  # type: ignore
+    logging.info(
+        f'Connected to Slack as "{slack_info["user"]}" with ID {slack_info["user_id"]}'
+    )
+
+    logging.info("Getting Slack users...")
+    directory = slack_directory.load(app.client, config)
+    logging.debug(f"Got {len(directory.users)} Slack users")
+
+    logging.info("Getting TidyHQ contacts...")
+    try:
+        contacts = tidyhq.index(config)
+    except requests.exceptions.RequestException:
+        logging.error(errors.tidyhq_connect)
+        sys.exit(1)
+    logging.debug(f"Got {len(contacts)} TidyHQ contacts")
+
+    channel_cache = planners.channel_cache(config)
+    mapping = None
+    if os.path.exists("synced_channels.json"):
+        mapping = planners.load_channel_mapping()
+    else:
+        logging.info("No synced_channels.json, skipping channel memberships")
+
+    plan = build_plan(
+        config,
+        contacts,
+        directory,
+        app.client,
+        mapping,
+        channel_cache=channel_cache,
+        removals="--remove" in sys.argv,
+    )
+
+    print(f"Profile changes: {len(plan['profiles'])}")
+    for slack_id, profile in plan["profiles"].items():
+        print(f"  {describe(slack_id, profile)}")
+    print(f"Channel invites: {sum(len(u) for u in plan['invites'].values())}")
+    for channel, users in plan["invites"].items():
+        print(f"  #{channel} add {len(users)}")
+    if plan["kicks"]:
+        print(f"Channel removals: {sum(len(u) for u in plan['kicks'].values())}")
+        for channel, users in plan["kicks"].items():
+            print(f"  #{channel} remove {len(users)}")
+
+    if "--live" not in sys.argv:
+        logging.info("Running in dry run mode, use --live to apply these changes")
+        sys.exit(0)
+
+    if "--cron" not in sys.argv:
+        answer = input("Action? [y/N]: ")
+        if answer.lower() != "y":
+            logging.info("Aborting")
+            sys.exit(0)
+
+    try:
+        failures = execute(
+            plan,
+            app.client,
+            limiter,
+            directory,
+            notifier,
+            channel_cache,
+            workers=helpers.workers_arg(),
+        )
+    finally:
+        notifier.flush()
+        directory.save()
+        channel_cache.save()
+
+    channel_changes = sum(
+        len(users)
+        for batches in (plan["invites"], plan["kicks"])
+        for users in batches.values()
+    )
+    logging.info(
+        f"Applied {len(plan['profiles']) - len(failures['profiles'])}/{len(plan['profiles'])} profile writes and "
+        f"{channel_changes - len(failures['channels'])}/{channel_changes} channel membership changes"
+    )
+    for target, error in failures["profiles"] + failures["channels"]:
+        logging.info(f"  {target}: {error}")
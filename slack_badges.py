@@ -1,14 +1,20 @@
 import json
 import logging
 import sys
-import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
 
 import requests
 from slack_bolt import App
+from slack_sdk.errors import SlackApiError
 
 import errors
+import helpers
+import notifications
+import planners
+import rate_limit
+import slack_directory
+import tidyhq
 
 # Check for --debug flag
 if len(sys.argv) > 1 and "--debug" in sys.argv:
@@ -16,139 +22,66 @@ if len(sys.argv) > 1 and "--debug" in sys.argv:
 else:
     logging.basicConfig(level=logging.INFO)
 
-# Check for --quiet flag
-quiet = False
+# Check for --notify=per-change|digest|none, --quiet is kept as an alias for none
+notify_mode = notifications.mode_arg()
 if len(sys.argv) > 1 and "--quiet" in sys.argv:
-    quiet = True
+    notify_mode = "none"
     logging.info("Running in quiet mode, no messages will be posted to Slack.")
 
+# Check for --workers=N, how many badge changes can be in flight at once
+workers = helpers.workers_arg()
+
 
 def get_tidyhq():
     logging.debug("Attempting to get contact dump from TidyHQ...")
     try:
-        r = requests.get(
-            "https://api.tidyhq.com/v1/contacts",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
-        contacts = r.json()
+        contacts = tidyhq.index(config)
     except requests.exceptions.RequestException:
         logging.error(errors.tidyhq_connect)
         return False
-    c = {}
-    for contact in contacts:
-        if contact["id"] in config["slack"]["membership_ignore"]:
-            continue
-        slack = ""
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"] and field["value"]:
-                slack = field["value"]
-                continue
-
-        # This script only deals with people that are linked in Slack
-        if not slack:
-            continue
-
-        # Check for relevant user groups
-        member_induction = False
-        member = False
-        committee = False
-        volunteer = False
-        for group in contact["groups"]:
-            if group["id"] in config["tidyhq"]["ids"]["members"]:
-                member = True
-            elif group["id"] in config["tidyhq"]["ids"]["committee"]:
-                committee = True
-            elif group["id"] in config["tidyhq"]["ids"]["member_induction"]:
-                member_induction = True
-            elif group["id"] in config["tidyhq"]["ids"]["volunteer"]:
-                volunteer = True
-
-        # Check for relevant custom fields
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"].get(
-                "volunteer_field"
-            ) and field.get("value"):
-                # This field is a comma separated list of dates stored as YYMM
-                dates = [x.strip() for x in field["value"].split(",")]
-                for date in dates:
-                    parsed_date = datetime.strptime(date, "%y%m")
-
-                    # Mark the user as a volunteer if the date is this or last month
-                    # Yes this could be checked with int comparisons but this seems more readable
-                    if (
-                        parsed_date.year == datetime.now().year
-                        and parsed_date.month
-                        in [datetime.now().month, datetime.now().month - 1]
-                    ):
-                        volunteer = True
-
-        if member or committee or volunteer:
-            c[slack] = {
-                "id": contact["id"],
-                "name": contact["display_name"],
-                "member": member,
-                "committee": committee,
-                "member_induction": member_induction,
-                "volunteer": volunteer,
-            }
-    return c
-
-
-def get_slack():
-    r = app.client.users_list()  # type: ignore
-    c = {}
-    while r.data.get("response_metadata", {}).get("next_cursor"):  # type: ignore
-        for user in r.data["members"]:  # type: ignore
-            if not user["is_bot"] and user["id"] != "USLACKBOT":
-                c[user["id"]] = {
-                    "emoji": user["profile"].get("status_emoji", False),
-                    "text": user["profile"].get("status_text", False),
-                }
-        r = app.client.users_list(cursor=r.data["response_metadata"]["next_cursor"])  # type: ignore
-    for user in r.data["members"]:  # type: ignore
-        if not user["is_bot"] and user["id"] != "USLACKBOT":
-            c[user["id"]] = {
-                "emoji": user["profile"].get("status_emoji", False),
-                "text": user["profile"].get("status_text", False),
-            }
-    return c
+    return planners.badge_contacts(config, contacts)
 
 
 def set_badge(slack_id, text=None, emoji=None):
-    if not text:
-        text = ""
-        emoji = ""
-    elif emoji and text:
-        # Emoji is already set
-        pass
-    elif text not in config["slack"]["status"]:
-        sys.exit(f"Invalid status: {text}")
-    else:
-        emoji = config["slack"]["status"][text]
-
-    profile = {
-        "status_text": text,
-        "status_emoji": emoji,
-        "status_expiration": 0,
-    }
+    try:
+        profile = planners.badge_profile(config, text=text, emoji=emoji)
+    except ValueError as e:
+        sys.exit(str(e))
+    text = profile["status_text"]
+    emoji = profile["status_emoji"]
 
-    app.client.users_profile_set(user=slack_id, profile=profile)
+    limiter.slack(app.client, "users_profile_set", user=slack_id, profile=profile)
+    directory.update_profile(slack_id, status_text=text, status_emoji=emoji)
 
     if text:
         message = f"Set badge for <@{slack_id}> to {emoji} {text}"
     else:
         message = f"Removed {text} badge from <@{slack_id}>"
     # Post a message to the notification channel
-    if not quiet:
-        bot_app.client.chat_postMessage(
-            channel=config["slack"]["notification_channel"],
-            text=message,
-            username="Slack Badges",
-            icon_emoji=":artifactory:",
-        )
-
-    # This method is rated to ~30 requests per minute, so we need to sleep
-    time.sleep(3)
+    notifier.notify(message)
+
+
+def apply_badges(changes: dict) -> list:
+    """Apply planned badge changes in parallel, returning the ones that failed
+
+    Throughput is bounded by the users.profile.set budget in the rate limiter rather than our own round-trips
+    """
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(set_badge, slack_id=slack_id, **change): slack_id
+            for slack_id, change in changes.items()
+        }
+        for future in as_completed(futures):
+            slack_id = futures[future]
+            try:
+                future.result()
+            except SlackApiError as e:
+                logging.error(
+                    f"Failed to set badge for {slack_id}: {e.response['error']}"
+                )
+                failures.append((slack_id, e.response["error"]))
+    return failures
 
 
 # load config from file
@@ -158,6 +91,15 @@ with open("config.json", "r") as f:
 # Initiate Slack client
 app = App(token=config["slack"]["user_token"])
 bot_app = App(token=config["slack"]["bot_token"])
+limiter = rate_limit.scheduler()
+notifier = notifications.Notifier(
+    bot_app.client,
+    channel=config["slack"]["notification_channel"],
+    title="Slack Badges",
+    mode=notify_mode,
+    username="Slack Badges",
+    icon_emoji=":artifactory:",
+)
 
 
 # Get info for our Slack connection
@@ -165,7 +107,8 @@ slack_info = app.client.auth_test()  # type: ignore
 print(f'Connected to Slack as "{slack_info["user"]}" with ID {slack_info["user_id"]}')
 
 logging.info("Getting Slack users...")
-slack_users = get_slack()
+directory = slack_directory.load(app.client, config)
+slack_users = planners.badge_slack_users(directory)
 logging.debug(f"Got {len(slack_users)} Slack users")
 
 logging.info("Getting TidyHQ users...")
@@ -174,70 +117,18 @@ if not tidyhq_users:
     exit(1)
 logging.debug(f"Got {len(tidyhq_users)} TidyHQ users")
 
-# Iterate over Slack users to find ones that have a status when we don't expect it
-for slack_user in slack_users:
-    # Skip users in the override list
-    if slack_user in [x["user"] for x in config["slack"].get("status_override", [])]:
-        continue
-
-    # Users that aren't in tidyhq wouldn't get their status fixed in the next step so strip them now
-    if slack_user not in tidyhq_users:
-        # Check if they have a status to remove
-        if slack_users[slack_user]["text"] or slack_users[slack_user]["emoji"]:
-            logging.info(
-                f'Removing status "{slack_users[slack_user]["text"]}" from {slack_user}'
-            )
-            set_badge(slack_id=slack_user, text=None)
-
-for tidyhq_user in tidyhq_users:
-    name = f"{tidyhq_users[tidyhq_user]['name']} ({tidyhq_user}/{tidyhq_users[tidyhq_user]['id']})"
-
-    # Check if user is present in both systems
-    if tidyhq_user not in slack_users:
-        logging.warning(f"{name} is in TidyHQ but not in Slack")
-        continue
-
-    emoji = None
-    title = None
-
-    if tidyhq_users[tidyhq_user]["committee"]:
-        emoji = config["slack"]["status"]["Committee"]
-        title = "Committee"
-    elif tidyhq_users[tidyhq_user]["volunteer"]:
-        emoji = config["slack"]["status"]["Volunteer"]
-        title = "Volunteer"
-    elif tidyhq_users[tidyhq_user]["member"]:
-        # Check for a member induction
-        emoji = config["slack"]["status"]["Uninducted"]
-        if tidyhq_users[tidyhq_user]["member_induction"]:
-            emoji = config["slack"]["status"]["Member"]
-        title = "Member"
-
-    if title:
-        # Check if the status is already set correctly
-        if (
-            slack_users[tidyhq_user]["text"] == title
-            and slack_users[tidyhq_user]["emoji"] == emoji
-        ):
-            logging.debug(f"{name} is already marked as {title}")
-        else:
-            set_badge(slack_id=tidyhq_user, text=title, emoji=emoji)
-            logging.info(f"Setting badge for {name} as {title}")
-
-# Process overrides
-for override in config["slack"].get("status_override"):
-    if override["user"] not in slack_users:
-        logging.warning(f"User {override['user']} not found in Slack")
-        continue
-    # Check if the user already has the correct title
-    if (
-        slack_users[override["user"]]["text"] == override["status"]
-        and slack_users[override["user"]]["emoji"]
-        == config["slack"]["status"][override["status"]]
-    ):
-        logging.debug(f"{override['user']} is already marked as {override['status']}")
-    else:
-        set_badge(slack_id=override["user"], text=override["status"])
-        logging.info(
-            f"Setting badge for {override['user']} as {override['status']} due to a hardcoded override. (config.json)"
-        )
+# Badge changes are planned first and applied together at the end
+changes = planners.plan_badges(config, tidyhq_users, slack_users)
+
+# Whatever got applied before an unexpected error is still reported and remembered
+try:
+    failures = apply_badges(changes)
+finally:
+    notifier.flush()
+    # Keep the shared directory in line with the statuses we've just set
+    directory.save()
+logging.info(
+    f"Applied {len(changes) - len(failures)} badge changes, {len(failures)} failed"
+)
+for slack_id, error in failures:
+    logging.info(f"  {slack_id}: {error}")
@@ -0,0 +1,151 @@
+"""Cached Slack user directory shared by the profile scripts.
+
+users_list is fetched at the maximum page size, trimmed down to the profile fields
+the scripts actually use and kept on disk for a configurable TTL so a batch of
+scripts run back to back only pages through the workspace once.
+"""
+
+import gzip
+import json
+import logging
+import time
+from typing import Any, Iterator
+
+import helpers
+import rate_limit
+from tidyhq import max_age_arg
+
+DIRECTORY_PATH = "slack_users.json.gz"
+
+# users.list accepts up to 1000 per page
+PAGE_SIZE = 1000
+
+PROFILE_FIELDS = [
+    "email",
+    "real_name",
+    "real_name_normalized",
+    "display_name",
+    "display_name_normalized",
+    "title",
+    "status_text",
+    "status_emoji",
+]
+
+
+def normalise_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def fetch(client) -> dict[str, dict[str, Any]]:
+    """Page through users.list and keep only the fields we care about"""
+    users: dict[str, dict[str, Any]] = {}
+    cursor = None
+    while True:
+        r = rate_limit.scheduler().slack(
+            client, "users_list", limit=PAGE_SIZE, cursor=cursor
+        )
+        for user in r["members"]:
+            users[user["id"]] = {
+                "id": user["id"],
+                "name": user.get("name", ""),
+                "is_bot": user.get("is_bot", False) or user["id"] == "USLACKBOT",
+                "deleted": user.get("deleted", False),
+                "profile": {
+                    field: user["profile"].get(field, "")
+                    for field in PROFILE_FIELDS
+                    if field in user["profile"]
+                },
+            }
+        cursor = r.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return users
+
+
+class SlackDirectory:
+    def __init__(self, path: str = DIRECTORY_PATH) -> None:
+        self.path = path
+        self.fetched_at = 0.0
+        self.users: dict[str, dict[str, Any]] = {}
+        self.emails: dict[str, dict[str, Any]] = {}
+        self._read()
+
+    def _read(self) -> None:
+        try:
+            with gzip.open(self.path, "rt") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.warning(f"Ignoring unreadable Slack directory {self.path}")
+            return
+        self.fetched_at = data["fetched_at"]
+        self._set_users(data["users"])
+
+    def _set_users(self, users: dict[str, dict[str, Any]]) -> None:
+        self.users = users
+        self.emails = {}
+        for user in users.values():
+            email = user["profile"].get("email")
+            if email:
+                self.emails[normalise_email(email)] = user
+
+    def save(self) -> None:
+        helpers.write_json(
+            self.path,
+            {"fetched_at": self.fetched_at, "users": self.users},
+            compress=True,
+        )
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def refresh(self, client) -> None:
+        started = time.time()
+        self._set_users(fetch(client))
+        self.fetched_at = started
+        self.save()
+
+    def load(self, client, max_age: float = 0) -> "SlackDirectory":
+        if not self.users or self.age() > max_age:
+            logging.debug("Fetching Slack user directory")
+            self.refresh(client)
+        else:
+            logging.debug(f"Using Slack directory from {int(self.age())} seconds ago")
+        return self
+
+    def get(self, user_id: str) -> dict[str, Any] | None:
+        return self.users.get(user_id)
+
+    def by_email(self, email: str) -> dict[str, Any] | None:
+        return self.emails.get(normalise_email(email))
+
+    def name(self, user_id: str) -> str | None:
+        """Display name, falling back to the username like the Slack client does"""
+        user = self.users.get(user_id)
+        if not user:
+            return None
+        return user["profile"].get("display_name") or user["name"]
+
+    def humans(self) -> Iterator[dict[str, Any]]:
+        """Users that aren't bots (or Slackbot)"""
+        return (user for user in self.users.values() if not user["is_bot"])
+
+    def update_profile(self, user_id: str, **fields: Any) -> None:
+        """Record a profile change we've made so the cache doesn't go stale, call save() afterwards"""
+        if user_id in self.users:
+            self.users[user_id]["profile"].update(fields)
+
+
+def load(
+    client, config: dict[str, Any], max_age: float | None = None
+) -> SlackDirectory:
+    """Get the shared directory
+
+    max_age defaults to --max-age, then slack/directory/ttl in config.json, then 0 (always refresh)
+    """
+    settings = config["slack"].get("directory", {})
+    if max_age is None:
+        max_age = max_age_arg(settings.get("ttl", 0))
+    return SlackDirectory(settings.get("path", DIRECTORY_PATH)).load(
+        client, max_age=max_age
+    )
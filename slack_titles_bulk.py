@@ -7,6 +7,8 @@ from pprint import pprint
 import requests
 
 import errors
+import planners
+import tidyhq
 
 # Check for --debug flag
 if len(sys.argv) > 1 and "--debug" in sys.argv:
@@ -18,38 +20,11 @@ else:
 def get_tidyhq():
     logging.debug("Attempting to get contact dump from TidyHQ...")
     try:
-        r = requests.get(
-            "https://api.tidyhq.com/v1/contacts",
-            params={"access_token": config["tidyhq"]["token"]},
-        )
-        contacts = r.json()
+        contacts = tidyhq.index(config)
     except requests.exceptions.RequestException:
         logging.error(errors.tidyhq_connect)
         return False
-    c = {}
-    for contact in contacts:
-        if contact["id"] in config["slack"]["membership_ignore"]:
-            continue
-        slack = ""
-        title = ""
-        for field in contact["custom_fields"]:
-            if field["id"] == config["tidyhq"]["ids"]["slack"] and field["value"]:
-                slack: str = field["value"]
-            elif field["id"] == config["tidyhq"]["ids"]["title"] and field["value"]:
-                title: str = field["value"]
-
-        # This script only deals with people that are linked in Slack
-        if not slack:
-            continue
-
-        # We only care about people with titles
-        if title:
-            c[slack] = {
-                "id": contact["id"],
-                "name": contact["display_name"],
-                "title": title,
-            }
-    return c
+    return planners.title_contacts(config, contacts)
 
 
 # load config from file
@@ -104,9 +79,8 @@ elif "--set" in sys.argv:
             f"Setting title for {user['name']} ({slack_id}) to {user['title']} in TidyHQ"
         )
         # Set the title in TidyHQ
-        r = requests.put(
-            f"https://api.tidyhq.com/v1/contacts/{user['id']}",
-            params={"access_token": config["tidyhq"]["token"]},
+        r = tidyhq.client(config).put(
+            f"contacts/{user['id']}",
             json={"custom_fields": {config["tidyhq"]["ids"]["title"]: user["title"]}},
         )
         if r.status_code != 200:
@@ -114,6 +88,7 @@ elif "--set" in sys.argv:
             exit(1)
 
     if changes:
+        tidyhq.expire_snapshot(config)
         logging.info("Changes made to TidyHQ. Use slack_titles.py to update Slack.")
 else:
     print("Usage: slack_titles_bulk.py [--read|--set] [--debug]")
@@ -0,0 +1,366 @@
+"""Shared TidyHQ API client.
+
+Keeps a single pooled HTTP session per process so scripts run back to back from
+cron don't renegotiate TLS for every request, asks for compressed responses,
+pages through list endpoints with limit/offset and retries 429/5xx responses
+with backoff.
+
+Contact dumps can also be served from an on-disk snapshot (see contacts()) so a
+batch of scripts only pays for the full download once, and indexed with
+ContactIndex (see index()) for constant time field/group/Slack ID lookups.
+"""
+
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import helpers
+
+BASE_URL = "https://api.tidyhq.com/v1/"
+
+# How many items to ask for per page, TidyHQ may send fewer if an endpoint caps it lower
+PAGE_SIZE = 1000
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+SNAPSHOT_PATH = "tidyhq_contacts.json.gz"
+
+LEVELS_PATH = "tidyhq_membership_levels.json"
+
+# Membership levels are only changed by hand every so often
+LEVELS_TTL = 24 * 60 * 60
+
+# Incremental refreshes can't see deleted contacts so fall back to a full pull this often
+FULL_REFRESH = 24 * 60 * 60
+
+# Allow for clock drift between us and TidyHQ when asking for recent changes
+UPDATE_OVERLAP = 5 * 60
+
+
+class TidyHQ:
+    def __init__(
+        self,
+        token: str,
+        page_size: int = PAGE_SIZE,
+        retries: int = 5,
+        backoff: float = 1,
+        pool_size: int = 10,
+    ) -> None:
+        self.token = token
+        self.page_size = page_size
+
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+        )
+
+        # PUT and DELETE are idempotent against TidyHQ so they're safe to retry, POST is not
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        params: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Send a request to the API and return the raw response"""
+        url = path if path.startswith("https://") else BASE_URL + path.lstrip("/")
+        params = {"access_token": self.token} | (params or {})
+        logging.debug(f"TidyHQ {method} {url}")
+        return self.session.request(method, url, params=params, **kwargs)
+
+    def get(self, path: str, params: dict[str, Any] | None = None) -> Any:
+        r = self.request("GET", path, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    def put(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def paginate(
+        self, path: str, params: dict[str, Any] | None = None
+    ) -> Iterator[dict[str, Any]]:
+        """Yield every item from a list endpoint, one page at a time
+
+        Stops on an empty page, or on a page with nothing new in case an endpoint
+        ignores offset and keeps sending the same items.
+        """
+        offset = 0
+        seen: set[Any] = set()
+        while True:
+            page = self.get(
+                path,
+                params=(params or {}) | {"limit": self.page_size, "offset": offset},
+            )
+            # A short page doesn't mean the end, the endpoint's cap may be lower than ours
+            if not page:
+                return
+            ids = {item.get("id", id(item)) for item in page}
+            if not ids - seen:
+                logging.warning(f"{path} sent the same page again, stopping")
+                return
+            seen |= ids
+            yield from page
+            offset += len(page)
+
+    def contacts(self, **params: Any) -> list[dict[str, Any]]:
+        return list(self.paginate("contacts", params))
+
+    def memberships(self, **params: Any) -> list[dict[str, Any]]:
+        return list(self.paginate("memberships", params))
+
+    def groups(self, **params: Any) -> list[dict[str, Any]]:
+        return list(self.paginate("groups", params))
+
+    def membership_levels(self, **params: Any) -> list[dict[str, Any]]:
+        return list(self.paginate("membership_levels", params))
+
+    def domain(self) -> str:
+        """Get the organisation prefix used in TidyHQ URLs"""
+        return self.get("organization")["domain_prefix"]
+
+
+_clients: dict[str, TidyHQ] = {}
+
+
+def client(config: dict[str, Any]) -> TidyHQ:
+    """Get the shared client for the token in config.json"""
+    token = config["tidyhq"]["token"]
+    if token not in _clients:
+        _clients[token] = TidyHQ(token)
+    return _clients[token]
+
+
+class ContactSnapshot:
+    """Compressed on-disk copy of the contact dump, refreshed with updated_since"""
+
+    def __init__(
+        self,
+        client: TidyHQ,
+        path: str = SNAPSHOT_PATH,
+        full_refresh: int = FULL_REFRESH,
+    ) -> None:
+        self.client = client
+        self.path = path
+        self.full_refresh = full_refresh
+        self.pulled_at = 0.0
+        self.full_pulled_at = 0.0
+        self.expired = False
+        self.contacts: dict[str, dict[str, Any]] = {}
+        self._read()
+
+    def _read(self) -> None:
+        try:
+            with gzip.open(self.path, "rt") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.warning(f"Ignoring unreadable contact snapshot {self.path}")
+            return
+        self.pulled_at = data["pulled_at"]
+        self.full_pulled_at = data["full_pulled_at"]
+        self.expired = data.get("expired", False)
+        self.contacts = data["contacts"]
+
+    def _write(self) -> None:
+        helpers.write_json(
+            self.path,
+            {
+                "pulled_at": self.pulled_at,
+                "full_pulled_at": self.full_pulled_at,
+                "expired": self.expired,
+                "contacts": self.contacts,
+            },
+            compress=True,
+        )
+
+    def age(self) -> float:
+        return time.time() - self.pulled_at
+
+    def refresh(self, full: bool = False) -> None:
+        started = time.time()
+        if (
+            full
+            or not self.contacts
+            or started - self.full_pulled_at > self.full_refresh
+        ):
+            logging.debug("Pulling full contact dump from TidyHQ")
+            self.contacts = {str(c["id"]): c for c in self.client.contacts()}
+            self.full_pulled_at = started
+        else:
+            since = datetime.fromtimestamp(
+                self.pulled_at - UPDATE_OVERLAP, tz=timezone.utc
+            ).strftime("%Y-%m-%dT%H:%M:%SZ")
+            changed = self.client.contacts(updated_since=since)
+            logging.debug(f"Got {len(changed)} contacts changed since {since}")
+            for contact in changed:
+                self.contacts[str(contact["id"])] = contact
+        self.pulled_at = started
+        self.expired = False
+        self._write()
+
+    def load(self, max_age: float = 0) -> list[dict[str, Any]]:
+        """Get every contact, only touching the network if the snapshot is older than max_age seconds"""
+        if not self.contacts or self.expired or self.age() > max_age:
+            self.refresh()
+        else:
+            logging.debug(f"Using contact snapshot from {int(self.age())} seconds ago")
+        return list(self.contacts.values())
+
+    def expire(self) -> None:
+        """Force the next load to check for changes regardless of max_age"""
+        if self.contacts:
+            self.expired = True
+            self._write()
+
+
+def max_age_arg(default: float = 0) -> float:
+    """Read --max-age <seconds> or --max-age=<seconds> from the command line"""
+    for i, arg in enumerate(sys.argv):
+        if arg.startswith("--max-age="):
+            return float(arg.split("=", 1)[1])
+        if arg == "--max-age" and i + 1 < len(sys.argv):
+            return float(sys.argv[i + 1])
+    return default
+
+
+def snapshot(config: dict[str, Any]) -> ContactSnapshot:
+    settings = config["tidyhq"].get("snapshot", {})
+    return ContactSnapshot(
+        client(config),
+        path=settings.get("path", SNAPSHOT_PATH),
+        full_refresh=settings.get("full_refresh", FULL_REFRESH),
+    )
+
+
+def contacts(
+    config: dict[str, Any], max_age: float | None = None
+) -> list[dict[str, Any]]:
+    """Get the contact dump via the shared snapshot
+
+    max_age defaults to --max-age, then tidyhq/snapshot/ttl in config.json, then 0 (always refresh)
+    """
+    if max_age is None:
+        max_age = max_age_arg(config["tidyhq"].get("snapshot", {}).get("ttl", 0))
+    return snapshot(config).load(max_age=max_age)
+
+
+def expire_snapshot(config: dict[str, Any]) -> None:
+    """Call after writing to contacts so the next script doesn't trust a stale snapshot"""
+    snapshot(config).expire()
+
+
+def membership_levels(
+    config: dict[str, Any], max_age: float | None = None
+) -> list[dict[str, Any]]:
+    """Get every membership level, kept on disk for tidyhq/levels/ttl seconds (default a day)"""
+    settings = config["tidyhq"].get("levels", {})
+    path = settings.get("path", LEVELS_PATH)
+    if max_age is None:
+        max_age = settings.get("ttl", LEVELS_TTL)
+    try:
+        if time.time() - os.path.getmtime(path) <= max_age:
+            with open(path, "r") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    levels = client(config).membership_levels()
+    helpers.write_json(path, levels)
+    return levels
+
+
+class ContactIndex:
+    """Lookups over a contact dump, built once so callers don't rescan custom fields and groups
+
+    Contact and group IDs are stored as strings since they arrive as ints from TidyHQ but
+    as strings from JSON mapping files.
+    """
+
+    def __init__(
+        self, contacts: list[dict[str, Any]], slack_field: str | None = None
+    ) -> None:
+        self.by_id: dict[str, dict[str, Any]] = {}
+        self.fields: dict[str, dict[str, Any]] = {}
+        self.contact_groups: dict[str, frozenset[str]] = {}
+        self.groups: dict[str, set[str]] = {}
+        self.group_labels: dict[str, str] = {}
+        self.by_slack: dict[str, dict[str, Any]] = {}
+
+        for contact in contacts:
+            contact_id = str(contact["id"])
+            self.by_id[contact_id] = contact
+            self.fields[contact_id] = {
+                field["id"]: field["value"]
+                for field in contact.get("custom_fields", [])
+                if field.get("value")
+            }
+
+            groups = []
+            for group in contact.get("groups", []):
+                group_id = str(group["id"])
+                groups.append(group_id)
+                self.group_labels[group_id] = group["label"]
+                self.groups.setdefault(group_id, set()).add(contact_id)
+            self.contact_groups[contact_id] = frozenset(groups)
+
+            if slack_field and slack_field in self.fields[contact_id]:
+                self.by_slack[self.fields[contact_id][slack_field]] = contact
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        return iter(self.by_id.values())
+
+    def field(self, contact_id: Any, field_id: str | None, default: Any = None) -> Any:
+        return self.fields[str(contact_id)].get(field_id, default)
+
+    @staticmethod
+    def group_set(group_ids: Any) -> frozenset[str]:
+        """Turn a group ID (or list of them) from config.json into something in_any() can use"""
+        if isinstance(group_ids, (list, tuple, set, frozenset)):
+            return frozenset(str(g) for g in group_ids)
+        return frozenset([str(group_ids)])
+
+    def in_any(self, contact_id: Any, group_ids: frozenset[str]) -> bool:
+        return not self.contact_groups[str(contact_id)].isdisjoint(group_ids)
+
+    def members_of(self, group_ids: frozenset[str]) -> set[str]:
+        members: set[str] = set()
+        for group_id in group_ids:
+            members |= self.groups.get(group_id, set())
+        return members
+
+
+def index(config: dict[str, Any], max_age: float | None = None) -> ContactIndex:
+    return ContactIndex(
+        contacts(config, max_age=max_age), slack_field=config["tidyhq"]["ids"]["slack"]
+    )
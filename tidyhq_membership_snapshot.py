@@ -1,29 +1,82 @@
+import csv
 import json
-from datetime import datetime
-import requests
+import sys
+from datetime import date as today
 from pprint import pprint
 
+import numpy as np
+
+import membership_table
+import tidyhq
+
+
+def get_arg(name, default=None):
+    """Read --name=value from the command line"""
+    for arg in sys.argv:
+        if arg.startswith(f"--{name}="):
+            return arg.split("=", 1)[1]
+    return default
+
+
+def write_csv(path, dates, counts):
+    levels = sorted(counts)
+    f = open(path, "w", newline="") if path else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(["date"] + levels + ["total"])
+        for i, day in enumerate(dates):
+            row = [int(counts[level][i]) for level in levels]
+            writer.writerow([str(day.astype("datetime64[D]"))] + row + [sum(row)])
+    finally:
+        if path:
+            f.close()
+
+
+def write_parquet(path, dates, counts):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit(
+            "Writing Parquet needs pyarrow, pip install pyarrow or use a .csv output"
+        )
+    columns = {"date": pa.array(dates.astype("datetime64[D]"))}
+    for level in sorted(counts):
+        columns[level] = pa.array(counts[level].astype(np.int64))
+    columns["total"] = pa.array(
+        np.sum([counts[level] for level in counts], axis=0, dtype=np.int64)
+        if counts
+        else np.zeros(len(dates), dtype=np.int64)
+    )
+    pq.write_table(pa.table(columns), path)
+
+
 # Load config from file
-with open('config.json') as f:
+with open("config.json") as f:
     config: dict = json.load(f)
-    
+
+# Load a complete list of memberships
+memberships = membership_table.MembershipTable(tidyhq.client(config).memberships())
+index = membership_table.IntervalIndex(memberships)
+
+# Check for --from=YYYY-MM-DD, counts for every --step up to --to instead of one date
+start = get_arg("from")
+if start:
+    dates = membership_table.date_range(
+        start, get_arg("to", today.today().isoformat()), get_arg("step", "month")
+    )
+    counts = index.level_counts(dates)
+    out = get_arg("out")
+    if out and out.endswith(".parquet"):
+        write_parquet(out, dates, counts)
+    else:
+        write_csv(out, dates, counts)
+    sys.exit(0)
+
 # Accept a date to use for the snapshot
 date = input("Enter date to use for snapshot (YYYY-MM-DD): ")
-date = datetime.strptime(date, "%Y-%m-%d")
-
-members = {}
-total = 0
+date = membership_table.as_datetime64(date)
 
-# Load a complete list of memberships
-memberships = requests.get("https://api.tidyhq.com/v1/memberships",params={"access_token":config["tidyhq"]["token"]}).json()
-for membership in memberships:
-    start_date = datetime.strptime(membership["start_date"], "%Y-%m-%dT%H:%M:%S+08:00")
-    end_date = datetime.strptime(membership["end_date"], "%Y-%m-%dT%H:%M:%S+08:00")
-    if start_date <= date <= end_date:
-        name = membership["membership_level"]["name"]
-        if name not in members:
-            members[name] = 0
-        members[name] += 1
-        total += 1
+members = index.count_active(date)
 pprint(members)
-print(f'Total: {total}')
\ No newline at end of file
+print(f"Total: {sum(members.values())}")
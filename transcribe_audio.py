@@ -1,9 +1,17 @@
 import io
 import json
 import logging
+import os
+import queue
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Iterable, Iterator
 
 import requests
 from openai import OpenAI
@@ -11,208 +19,445 @@ from pydub import AudioSegment
 from slack_bolt import App
 from slack_sdk.web.slack_response import SlackResponse
 
-# Check for --debug flag
-if len(sys.argv) > 1 and "--debug" in sys.argv:
-    logging.basicConfig(level=logging.DEBUG)
-else:
-    logging.basicConfig(level=logging.INFO)
-
-# load config from file
-with open("config.json", "r") as f:
-    config = json.load(f)
-
-# Initiate OpenAI client
-if config["slack"]["transcribe_calls"]:
-    openai_client = OpenAI(api_key=config["openai"]["api_key"])
-
-# Initiate Slack client as our user
-app = App(token=config["slack"]["user_token"])
-posting_app = App(token=config["slack"]["bot_token"])
-
-# Get info for our Slack connection
-slack_info = app.client.auth_test()  # type: ignore
-print(f'Connected to Slack as "{slack_info["user"]}" with ID {slack_info["user_id"]}')
-
-# Get all activity in the channel
-channel_id = config["slack"]["phone_channel"]
-response = app.client.conversations_history(channel=channel_id, limit=999)
-messages = response["messages"]
-
-print(f"Found {len(messages)} messages in channel {channel_id}")
-
-name_map = {}
-
-
-def transcode_to_mp3(wav_content) -> bytes:
-    audio = AudioSegment.from_wav(io.BytesIO(wav_content))
-    mp3_io = io.BytesIO()
-    audio.export(mp3_io, format="mp3")
-    return mp3_io.getvalue()
-
-
-# Work from oldest messages to newest
-messages.reverse()
-
-for message in messages:
+import rate_limit
+
+# How many calls can be downloaded, transcoded and transcribed ahead of the one being
+# posted. Keeps memory flat however long the backlog is.
+MAX_IN_FLIGHT = 8
+
+# Downloads, Whisper and Slack calls spend their time waiting on the network
+NETWORK_WORKERS = 4
+
+# Encoding is CPU bound so gets real processes
+TRANSCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+PHONE_NUMBER = re.compile(r"[\d]+")
+
+# Overridden by slack/voicemail_audio in config.json. Phone audio is 8kHz mono to begin
+# with so anything more is wasted bytes.
+AUDIO_DEFAULTS = {
+    # Pipe the download through ffmpeg rather than holding the WAV in memory
+    "streaming": True,
+    "format": "mp3",
+    "bitrate": "32k",
+    "sample_rate": 16000,
+    "channels": 1,
+}
+
+# ffmpeg settings for each output format. Whisper accepts both, but Slack only plays
+# mp3 in the browser and offers Opus as a download.
+AUDIO_FORMATS = {
+    "mp3": {
+        "codec": "libmp3lame",
+        "container": "mp3",
+        "extension": "mp3",
+        "mimetype": "audio/mpeg",
+        "args": [],
+    },
+    "opus": {
+        "codec": "libopus",
+        "container": "ogg",
+        "extension": "ogg",
+        "mimetype": "audio/ogg",
+        "args": ["-application", "voip"],
+    },
+}
+
+# Bytes read from the download and from ffmpeg at a time
+CHUNK_SIZE = 64 * 1024
+
+# Encoded audio larger than this is kept in a temporary file instead of memory
+SPOOL_SIZE = 1024 * 1024
+
+
+def audio_settings(config: dict[str, Any]) -> dict[str, Any]:
+    settings = {**AUDIO_DEFAULTS, **config["slack"].get("voicemail_audio", {})}
+    if settings["format"] not in AUDIO_FORMATS:
+        raise ValueError(
+            f"Unknown voicemail format {settings['format']}, expected one of {', '.join(AUDIO_FORMATS)}"
+        )
+    return settings
+
+
+def transcode(wav_content: bytes, settings: dict[str, Any]) -> bytes:
+    """Decode a whole WAV and encode it in one go, run in a transcoder process"""
+    output = AUDIO_FORMATS[settings["format"]]
+    segment = AudioSegment.from_wav(io.BytesIO(wav_content))
+    segment = segment.set_channels(settings["channels"]).set_frame_rate(
+        settings["sample_rate"]
+    )
+    encoded = io.BytesIO()
+    segment.export(
+        encoded,
+        format=output["container"],
+        codec=output["codec"],
+        bitrate=settings["bitrate"],
+        parameters=output["args"],
+    )
+    return encoded.getvalue()
+
+
+def ffmpeg_command(settings: dict[str, Any]) -> list[str]:
+    output = AUDIO_FORMATS[settings["format"]]
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        "pipe:0",
+        "-vn",
+        "-ac",
+        str(settings["channels"]),
+        "-ar",
+        str(settings["sample_rate"]),
+        "-c:a",
+        output["codec"],
+        "-b:a",
+        str(settings["bitrate"]),
+        *output["args"],
+        "-f",
+        output["container"],
+        "pipe:1",
+    ]
+
+
+def stream_transcode(
+    chunks: Iterable[bytes], settings: dict[str, Any]
+) -> Iterator[bytes]:
+    """Pipe audio through ffmpeg, yielding encoded output as it's produced
+
+    Only a chunk or two of the input and output is ever held in memory.
+    """
+    with tempfile.TemporaryFile() as stderr, subprocess.Popen(
+        ffmpeg_command(settings),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+    ) as ffmpeg:
+        failed: list[BaseException] = []
+
+        # Feed ffmpeg from another thread so neither pipe can fill up and stall it
+        def feed() -> None:
+            try:
+                for chunk in chunks:
+                    ffmpeg.stdin.write(chunk)
+            except BrokenPipeError:
+                # ffmpeg gave up, its exit code says why
+                pass
+            except BaseException as e:
+                failed.append(e)
+            finally:
+                try:
+                    ffmpeg.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while chunk := ffmpeg.stdout.read(CHUNK_SIZE):
+                yield chunk
+            feeder.join()
+        finally:
+            # Don't leave ffmpeg running if we were stopped early
+            if feeder.is_alive():
+                ffmpeg.kill()
+                feeder.join()
+
+        if failed:
+            raise failed[0]
+        if ffmpeg.wait() != 0:
+            stderr.seek(0)
+            error = stderr.read().decode(errors="replace").strip()
+            raise RuntimeError(f"ffmpeg exited with {ffmpeg.returncode}: {error}")
+
+
+def parse_message(message: dict[str, Any]) -> dict[str, Any] | None:
+    """Work out what a phone email is about, None if it isn't one we handle"""
     # Skip messages from users
     if "bot_id" not in message:
-        continue
+        return None
 
     # Skip messages without an email attached
     if "files" not in message:
-        continue
+        return None
 
     email: dict = message["files"][0]
 
     subject: str = email["title"]
 
     # Extract the first phone number from the subject
-    pattern = re.compile(r"[\d]+")
-    match = pattern.search(subject)
+    match = PHONE_NUMBER.search(subject)
     if match:
         phone_number: str = match.group()
-        linked_number: str = f"<tel:{phone_number}|{phone_number}>"
     else:
         logging.error(f"No phone number found in subject: {subject}")
-        continue
+        return None
 
     if "voicemail" in subject.lower():
         call_type = "voicemail"
     elif "missed call" in subject.lower():
         call_type = "missed"
+    else:
+        logging.error(f"Unknown call type in subject: {subject}")
+        return None
 
-    # Look for voicemails
-    if "attachments" in email and call_type == "voicemail":
-        attachment: dict = email["attachments"][0]
-        if "audio" in attachment["mimetype"]:
-            # Download the audio file
-            file_url: str = attachment["url"]
-            print(f"Downloading {file_url}")
-            r = requests.get(
-                file_url,
-                headers={"Authorization": "Bearer " + config["slack"]["bot_token"]},
-            )
-            if r.status_code != 200:
-                logging.error(f"Failed to download {file_url}")
-                continue
+    attachment = None
+    if call_type == "voicemail":
+        # Look for the recording
+        if "attachments" in email and "audio" in email["attachments"][0]["mimetype"]:
+            attachment = email["attachments"][0]
+        else:
+            logging.error(f"No recording attached to voicemail: {subject}")
+            return None
 
-            # Transcode the audio file to mp3
-            print("Transcoding audio file to mp3")
-            voicemail: bytes = transcode_to_mp3(r.content)
+    # Generate a human readable timestamp for the message
+    ts: str = message["ts"].split(".")[0]
+    timestamp: str = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(ts)))
 
-            # Send the file as a file-like object
-            mp3_io = io.BytesIO(voicemail)
-            mp3_io.name = attachment["filename"].replace(".wav", ".mp3")
+    return {
+        "ts": message["ts"],
+        "call_type": call_type,
+        "phone_number": phone_number,
+        "linked_number": f"<tel:{phone_number}|{phone_number}>",
+        "timestamp": timestamp,
+        "attachment": attachment,
+    }
+
+
+def prepare(
+    call: dict[str, Any], transcoder: ProcessPoolExecutor
+) -> dict[str, Any] | None:
+    """Download, transcode, transcribe and upload a voicemail, None if it couldn't be fetched
+
+    Runs on a network worker. Streaming transcodes run in an ffmpeg subprocess as the
+    download arrives, otherwise the encode is handed to a transcoder process.
+    """
+    if call["call_type"] != "voicemail":
+        return call
+    attachment = call["attachment"]
+    output = AUDIO_FORMATS[audio["format"]]
+    filename = f"{os.path.splitext(attachment['filename'])[0]}.{output['extension']}"
+
+    # Download the audio file
+    file_url: str = attachment["url"]
+    print(f"Downloading {file_url}")
+    with requests.get(
+        file_url,
+        headers={"Authorization": "Bearer " + config["slack"]["bot_token"]},
+        stream=audio["streaming"],
+    ) as r:
+        if r.status_code != 200:
+            logging.error(f"Failed to download {file_url}")
+            return None
+
+        # Transcode the audio file
+        print(f"Transcoding {attachment['filename']} to {audio['format']}")
+        if audio["streaming"]:
+            voicemail = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            try:
+                for chunk in stream_transcode(r.iter_content(CHUNK_SIZE), audio):
+                    voicemail.write(chunk)
+            except BaseException:
+                voicemail.close()
+                raise
+        else:
+            voicemail = io.BytesIO(
+                transcoder.submit(transcode, r.content, audio).result()
+            )
 
-            if config["slack"]["transcribe_calls"]:
+    with voicemail:
+        length = voicemail.seek(0, io.SEEK_END)
+        call["transcription"] = ""
+        if config["slack"]["transcribe_calls"]:
+            voicemail.seek(0)
+            try:
                 transcription: str = openai_client.audio.transcriptions.create(
                     model="whisper-1",
-                    file=mp3_io,
+                    file=(filename, voicemail),
                     response_format="text",
                     language="en",
                 )
-                transcription = f"\n\n{transcription}"
-            else:
-                transcription = ""
-
-    # Generate a human readable timestamp for the message
-    ts: str = message["ts"].split(".")[0]
-    timestamp: str = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(ts)))
-
-    posted = False
-
-    if call_type == "voicemail":
-        # Upload the mp3 to Slack
-        upload_info: SlackResponse = posting_app.client.files_getUploadURLExternal(
-            filename=attachment["filename"].replace(".wav", ".mp3"),
-            length=len(voicemail),
-            alt_text=f"Voicemail from {phone_number}",
-        )
-
-        upload_url: str = upload_info["upload_url"]
-        uploaded_file: str = upload_info["file_id"]
-
-        # Upload the file
-        response = requests.post(
-            upload_url,
-            files={
-                "file": (
-                    attachment["filename"].replace(".wav", ".mp3"),
-                    voicemail,
-                    "audio/mp3",
-                )
-            },
-        )
-        if response.status_code != 200:
-            logging.error(f"Failed to upload file to {upload_url}")
-
-        # Send a message to the channel with the transcription
-        notification_message: SlackResponse = posting_app.client.chat_postMessage(
-            channel=channel_id,
-            text=f"Voicemail from {phone_number}",
-            blocks=[
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"New voicemail from {linked_number}{transcription}",
-                    },
-                },
-                {
-                    "type": "context",
-                    "elements": [
-                        {
-                            "type": "plain_text",
-                            "text": timestamp,
-                        }
-                    ],
+                call["transcription"] = f"\n\n{transcription}"
+            except Exception as e:
+                # Still worth posting the recording without it
+                logging.error(f"Failed to transcribe {attachment['filename']}: {e}")
+
+        call["file_id"] = upload(filename, voicemail, length, output["mimetype"], call)
+    return call
+
+
+def upload(
+    filename: str, voicemail, length: int, mimetype: str, call: dict[str, Any]
+) -> str:
+    """Upload a recording to Slack, returning the file ID to attach once the message is posted"""
+    upload_info: SlackResponse = limiter.slack(
+        posting_app.client,
+        "files_getUploadURLExternal",
+        filename=filename,
+        length=length,
+        alt_text=f"Voicemail from {call['phone_number']}",
+    )
+    upload_url: str = upload_info["upload_url"]
+
+    # Upload the file as the raw body, requests streams it from the open file rather
+    # than building a multipart copy in memory
+    voicemail.seek(0)
+    response = requests.post(
+        upload_url,
+        data=voicemail,
+        headers={"Content-Type": mimetype},
+    )
+    if response.status_code != 200:
+        logging.error(f"Failed to upload file to {upload_url}")
+    return upload_info["file_id"]
+
+
+def post(call: dict[str, Any]) -> SlackResponse:
+    """Post the notification for a call, attaching the recording of a voicemail"""
+    if call["call_type"] == "voicemail":
+        text = f"Voicemail from {call['phone_number']}"
+        body = f"New voicemail from {call['linked_number']}{call['transcription']}"
+    else:
+        text = f"Missed call from {call['phone_number']}"
+        body = f"Missed call from {call['linked_number']}"
+
+    notification_message: SlackResponse = limiter.slack(
+        posting_app.client,
+        "chat_postMessage",
+        channel=channel_id,
+        text=text,
+        blocks=[
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": body,
                 },
-            ],
-            icon_emoji=":phone:",
-            username="Celia | Phone Assistant",
-        )
+            },
+            {
+                "type": "context",
+                "elements": [
+                    {
+                        "type": "plain_text",
+                        "text": call["timestamp"],
+                    }
+                ],
+            },
+        ],
+        icon_emoji=":phone:",
+        username="Celia | Phone Assistant",
+    )
 
+    if call["call_type"] == "voicemail":
         # Complete the file upload and add the file to the message
-        posting_app.client.files_completeUploadExternal(
-            files=[{"id": uploaded_file, "title": f"Voicemail from {phone_number}"}],
+        limiter.slack(
+            posting_app.client,
+            "files_completeUploadExternal",
+            files=[{"id": call["file_id"], "title": text}],
             channel_id=channel_id,
             thread_ts=notification_message["ts"],
         )
-        posted = True
-
-    elif call_type == "missed":
-        notification_message = posting_app.client.chat_postMessage(
-            channel=channel_id,
-            text=f"Missed call from {phone_number}",
-            blocks=[
-                {
-                    "type": "section",
-                    "text": {
-                        "type": "mrkdwn",
-                        "text": f"Missed call from {linked_number}",
-                    },
-                },
-                {
-                    "type": "context",
-                    "elements": [
-                        {
-                            "type": "plain_text",
-                            "text": timestamp,
-                        }
-                    ],
-                },
-            ],
-            icon_emoji=":phone:",
-            username="Celia | Phone Assistant",
-        )
-        posted = True
+    return notification_message
+
+
+def tidy_up(call: dict[str, Any], notification_ts: str) -> None:
+    # Pin the root message to the channel
+    limiter.slack(
+        posting_app.client, "pins_add", channel=channel_id, timestamp=notification_ts
+    )
 
     # Delete the email
-    if posted:
-        # Pin the root message to the channel
-        posting_app.client.pins_add(
-            channel=channel_id, timestamp=notification_message["ts"]
-        )
+    limiter.slack(app.client, "chat_delete", channel=channel_id, ts=call["ts"])
+
+
+def queue_calls(
+    calls: list[dict[str, Any]],
+    network: ThreadPoolExecutor,
+    transcoder: ProcessPoolExecutor,
+    prepared: queue.Queue,
+) -> None:
+    """Start preparing calls in order, blocking once MAX_IN_FLIGHT are waiting to be posted"""
+    for call in calls:
+        prepared.put((call, network.submit(prepare, call, transcoder)))
+    prepared.put(None)
+
+
+# Everything below talks to Slack, so it only runs in the main process and not in the
+# transcoder processes
+if __name__ == "__main__":
+    # Check for --debug flag
+    if len(sys.argv) > 1 and "--debug" in sys.argv:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    # load config from file
+    with open("config.json", "r") as f:
+        config = json.load(f)
+
+    audio = audio_settings(config)
+    if shutil.which("ffmpeg") is None:
+        sys.exit("Transcoding voicemails needs ffmpeg on the PATH")
+
+    # Initiate OpenAI client
+    if config["slack"]["transcribe_calls"]:
+        openai_client = OpenAI(api_key=config["openai"]["api_key"])
+
+    # Initiate Slack client as our user
+    app = App(token=config["slack"]["user_token"])
+    posting_app = App(token=config["slack"]["bot_token"])
+    limiter = rate_limit.scheduler()
+
+    # Get info for our Slack connection
+    slack_info = app.client.auth_test()  # type: ignore
+    print(
+        f'Connected to Slack as "{slack_info["user"]}" with ID {slack_info["user_id"]}'
+    )
+
+    # Get all activity in the channel
+    channel_id = config["slack"]["phone_channel"]
+    response = app.client.conversations_history(channel=channel_id, limit=999)
+    messages = response["messages"]
+
+    print(f"Found {len(messages)} messages in channel {channel_id}")
+
+    # Work from oldest messages to newest
+    messages.reverse()
+    calls = [call for call in map(parse_message, messages) if call]
+    print(f"Found {len(calls)} calls to post")
+
+    # Calls are prepared concurrently but come off this queue, and so get posted, in
+    # the order they were received
+    prepared: queue.Queue = queue.Queue(maxsize=MAX_IN_FLIGHT)
+    tidying: list[Future] = []
+    with ThreadPoolExecutor(
+        max_workers=NETWORK_WORKERS
+    ) as network, ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS) as transcoder:
+        threading.Thread(
+            target=queue_calls,
+            args=(calls, network, transcoder, prepared),
+            daemon=True,
+        ).start()
+
+        while (item := prepared.get()) is not None:
+            call, future = item
+            try:
+                ready = future.result()
+            except Exception:
+                logging.exception(f"Failed to prepare call from {call['phone_number']}")
+                continue
+            if ready is None:
+                continue
+
+            notification_message = post(ready)
+
+            # Pinning and deleting the email don't need to hold up the next post
+            tidying.append(network.submit(tidy_up, ready, notification_message["ts"]))
 
-        # Delete the email
-        app.client.chat_delete(channel=channel_id, ts=message["ts"])
+        for future in tidying:
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Failed to pin notification or delete email")